@@ -0,0 +1,54 @@
+"""ocr jobs
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+import uuid
+
+
+# revision identifiers, used by Alembic.
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "ocr_jobs",
+        sa.Column("id", sa.dialects.postgresql.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4),
+        sa.Column(
+            "stage",
+            sa.Enum(
+                "saved",
+                "preprocessing",
+                "recognizing",
+                "parsing",
+                "persisting",
+                "done",
+                "failed",
+                name="ocrjobstage",
+            ),
+            nullable=False,
+            server_default="saved",
+        ),
+        sa.Column("image_path", sa.String(), nullable=False),
+        sa.Column(
+            "receipt_id",
+            sa.dialects.postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("receipts.id", ondelete="SET NULL"),
+            nullable=True,
+        ),
+        sa.Column("error", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("ocr_jobs")
+    op.execute("DROP TYPE IF EXISTS ocrjobstage")
@@ -0,0 +1,40 @@
+"""payment idempotency keys
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "payment_idempotency_keys",
+        sa.Column(
+            "receipt_id",
+            sa.dialects.postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("receipts.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("key", sa.String(128), primary_key=True),
+        sa.Column("request_hash", sa.String(64), nullable=False),
+        sa.Column("response", sa.dialects.postgresql.JSONB(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+    op.create_index(
+        "ix_payment_idempotency_keys_created_at", "payment_idempotency_keys", ["created_at"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_payment_idempotency_keys_created_at", table_name="payment_idempotency_keys")
+    op.drop_table("payment_idempotency_keys")
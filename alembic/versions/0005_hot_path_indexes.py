@@ -0,0 +1,48 @@
+"""indexes for room load and payment lookups
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+
+Indexes are built CONCURRENTLY outside the migration transaction, so applying
+this to a live database does not block writes to the tables. A failed
+concurrent build leaves an INVALID index behind that IF NOT EXISTS would skip;
+drop it before running the upgrade again.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ("ix_items_receipt_id", "items", ["receipt_id"], {}),
+    (
+        "ix_item_units_unpaid",
+        "item_units",
+        ["item_id", "unit_index"],
+        {"postgresql_where": sa.text("amount_paid < amount_total")},
+    ),
+    ("ix_payments_receipt_id_created_at", "payments", ["receipt_id", sa.text("created_at DESC")], {}),
+    ("ix_payments_item_id", "payments", ["item_id"], {}),
+    ("ix_payments_unit_id", "payments", ["unit_id"], {}),
+    ("ix_ocr_jobs_receipt_id", "ocr_jobs", ["receipt_id"], {}),
+]
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns, options in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **options)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
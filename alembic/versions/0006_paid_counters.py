@@ -0,0 +1,60 @@
+"""paid counters on items and receipts
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("items", sa.Column("units_paid", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("items", sa.Column("amount_paid", sa.Numeric(10, 2), nullable=False, server_default="0"))
+    op.add_column("receipts", sa.Column("units_total", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("receipts", sa.Column("units_paid", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("receipts", sa.Column("amount_paid", sa.Numeric(10, 2), nullable=False, server_default="0"))
+
+    op.execute(
+        """
+        UPDATE items
+        SET units_paid = actual.units_paid, amount_paid = actual.amount_paid
+        FROM (
+            SELECT item_id, count(*) FILTER (WHERE status = 'paid') AS units_paid, sum(amount_paid) AS amount_paid
+            FROM item_units
+            GROUP BY item_id
+        ) AS actual
+        WHERE items.id = actual.item_id
+        """
+    )
+    op.execute(
+        """
+        UPDATE receipts
+        SET units_total = actual.units_total, units_paid = actual.units_paid, amount_paid = actual.amount_paid
+        FROM (
+            SELECT items.receipt_id,
+                   count(item_units.id) AS units_total,
+                   count(item_units.id) FILTER (WHERE item_units.status = 'paid') AS units_paid,
+                   coalesce(sum(item_units.amount_paid), 0) AS amount_paid
+            FROM items JOIN item_units ON item_units.item_id = items.id
+            GROUP BY items.receipt_id
+        ) AS actual
+        WHERE receipts.id = actual.receipt_id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("receipts", "amount_paid")
+    op.drop_column("receipts", "units_paid")
+    op.drop_column("receipts", "units_total")
+    op.drop_column("items", "amount_paid")
+    op.drop_column("items", "units_paid")
@@ -1,30 +1,57 @@
+import asyncio
 import logging
 import secrets
 import uuid
+from collections.abc import AsyncIterator, Iterator
+from contextlib import contextmanager
+from datetime import datetime
 from decimal import Decimal
 from pathlib import Path
 
-from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, status
-from pytesseract import TesseractError, TesseractNotFoundError
-from sqlalchemy import delete, select
+from fastapi import APIRouter, BackgroundTasks, Depends, File, Form, Header, HTTPException, Request, Response, UploadFile, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, func, insert, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.config import get_settings
+from app.core.fastjson import dumps, json_response
 from app.core.websocket_manager import manager
-from app.db import get_session
-from app.models import ItemUnit, Payment, Receipt, ReceiptItem, ReceiptStatus
+from app.db import async_session, background_session, get_session
+from app.models import ItemUnit, OcrJob, OcrJobStage, Receipt, ReceiptItem, ReceiptStatus
 from app.schemas import (
+    BatchFileResult,
+    BatchReceiptResult,
     FinalizeResponse,
     ItemSchema,
+    ItemDraft,
     ItemUpdate,
+    OcrCacheStats,
+    OcrJobResponse,
     OcrPreviewResponse,
     ParsedOcrItem,
+    PaymentDelta,
     PaymentRequest,
+    PaymentResponse,
     ReceiptRoomResponse,
     ReceiptUploadResponse,
+    WebSocketStats,
 )
-from app.services.ocr import extract_items
-from app.services.payments import PaymentError, process_payment_lines
+from app.services.idempotency import IDEMPOTENCY_KEY_MAX_LENGTH, claim_key, request_fingerprint, store_response
+from app.services.ocr import (
+    SavedUpload,
+    UnsupportedImageType,
+    UploadTooLarge,
+    extract_items,
+    recognize_image,
+    save_upload,
+)
+from app.services.ocr_backends import OcrEngineError, OcrEngineNotFound
+from app.services.ocr_cache import ocr_cache
+from app.services.ocr_jobs import publish_job, spawn_job, update_job
+from app.services.ocr_pool import OcrQueueFull, OcrReservation, OcrTimeout, ocr_pool
+from app.services.payments import PaymentError, PaymentResult, process_payment_lines
+from app.services.room_snapshots import room_snapshots
 
 
 router = APIRouter(prefix="/api")
@@ -32,28 +59,58 @@ settings = get_settings()
 logger = logging.getLogger(__name__)
 
 
-def _validate_upload(file: UploadFile) -> int:
-    if not file.content_type or "image" not in file.content_type:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file type")
-    file.file.seek(0, 2)
-    size = file.file.tell()
-    file.file.seek(0)
+def _validate_upload(file: UploadFile) -> int | None:
+    # The type is sniffed and the limit enforced again while streaming in save_upload;
+    # this only rejects uploads whose declared size is already too large.
     max_bytes = settings.upload_max_mb * 1024 * 1024
-    if size > max_bytes:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File too large")
-    return size
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File too large")
+    return file.size
 
 
-async def _run_ocr(file: UploadFile, media_root: Path) -> tuple[Path, str, list[ParsedOcrItem]]:
+def _revision_etag(receipt_id: uuid.UUID, revision: int) -> str:
+    return f'"{receipt_id.hex}-{revision}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+@contextmanager
+def _ocr_errors() -> Iterator[None]:
     try:
-        return await extract_items(file, media_root=media_root)
-    except TesseractNotFoundError as exc:
+        yield
+    except OcrQueueFull as exc:
+        logger.warning("Rejecting receipt upload: %s", exc)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="OCR перегружен, повторите попытку позже",
+            headers={"Retry-After": str(settings.ocr_retry_after_seconds)},
+        ) from exc
+    except UnsupportedImageType as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file type") from exc
+    except UploadTooLarge as exc:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File too large") from exc
+    except OcrTimeout as exc:
+        logger.warning("Receipt OCR timed out: %s", exc)
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Распознавание чека заняло слишком много времени",
+        ) from exc
+    except OcrEngineNotFound as exc:
         logger.exception("Tesseract is not installed or not configured")
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="OCR недоступен: отсутствует бинарник Tesseract",
         ) from exc
-    except TesseractError as exc:
+    except OcrEngineError as exc:
         logger.exception("Tesseract failed to process the image")
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -74,6 +131,33 @@ async def _run_ocr(file: UploadFile, media_root: Path) -> tuple[Path, str, list[
         ) from exc
 
 
+async def _run_ocr(file: UploadFile, media_root: Path) -> tuple[Path, str, list[ParsedOcrItem]]:
+    with _ocr_errors():
+        return await extract_items(file, media_root=media_root)
+
+
+async def _create_draft_receipt(
+    session: AsyncSession, image_path: Path, parsed_items: list[ParsedOcrItem]
+) -> tuple[Receipt, list[dict]]:
+    receipt = Receipt(image_path=str(image_path), status=ReceiptStatus.draft)
+    session.add(receipt)
+    await session.flush()
+    items = [
+        {
+            "id": uuid.uuid4(),
+            "receipt_id": receipt.id,
+            "name": parsed.name or "Без названия",
+            "qty_total": parsed.quantity,
+            "unit_price": parsed.price,
+            "amount_total": parsed.total,
+        }
+        for parsed in parsed_items
+    ]
+    if items:
+        await session.execute(insert(ReceiptItem), items)
+    return receipt, items
+
+
 @router.post("/receipts/preview", response_model=OcrPreviewResponse)
 async def preview_receipt(file: UploadFile) -> OcrPreviewResponse:
     size = _validate_upload(file)
@@ -100,21 +184,7 @@ async def upload_receipt(
 
     media_root = Path(settings.media_root)
     path, text, parsed_items = await _run_ocr(file, media_root=media_root)
-    receipt = Receipt(image_path=str(path), status=ReceiptStatus.draft)
-    session.add(receipt)
-    await session.flush()
-    items: list[ReceiptItem] = []
-    for parsed in parsed_items:
-        name = parsed.name or "Без названия"
-        item = ReceiptItem(
-            receipt_id=receipt.id,
-            name=name,
-            qty_total=parsed.quantity,
-            unit_price=parsed.price,
-            amount_total=parsed.total,
-        )
-        session.add(item)
-        items.append(item)
+    receipt, items = await _create_draft_receipt(session, path, parsed_items)
     await session.commit()
     logger.info(
         "Receipt %s saved with %d parsed items. First characters of OCR text: %s",
@@ -125,42 +195,249 @@ async def upload_receipt(
     return ReceiptUploadResponse(receipt_id=receipt.id, items=items)
 
 
+async def _stream_batch(
+    filenames: list[str], uploads: list[SavedUpload], stitch: bool, reservation: OcrReservation
+) -> AsyncIterator[str]:
+    async def recognize(index: int) -> tuple[int, list[ParsedOcrItem], str | None]:
+        try:
+            with _ocr_errors():
+                _, parsed_items = await recognize_image(uploads[index], reservation=reservation)
+        except HTTPException as exc:
+            return index, [], str(exc.detail)
+        return index, parsed_items, None
+
+    tasks = [asyncio.create_task(recognize(index)) for index in range(len(uploads))]
+    parsed_by_index: dict[int, list[ParsedOcrItem]] = {}
+    # Uploads a saved receipt points to; every other one is deleted when the stream ends.
+    referenced: set[int] = set()
+    failed = False
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, parsed_items, error = await next_done
+            result = BatchFileResult(index=index, filename=filenames[index], items=parsed_items, error=error)
+            if error is not None:
+                failed = True
+            elif not stitch:
+                async with async_session() as session:
+                    receipt, _ = await _create_draft_receipt(session, uploads[index].path, parsed_items)
+                    await session.commit()
+                referenced.add(index)
+                result.receipt_id = receipt.id
+            parsed_by_index[index] = parsed_items
+            yield result.json() + "\n"
+        if stitch:
+            if failed:
+                yield BatchReceiptResult(error="Не все фотографии удалось распознать, чек не создан").json() + "\n"
+                return
+            # Pages keep upload order regardless of which finished first; the first photo represents the receipt.
+            merged = [item for index in sorted(parsed_by_index) for item in parsed_by_index[index]]
+            async with async_session() as session:
+                receipt, items = await _create_draft_receipt(session, uploads[0].path, merged)
+                await session.commit()
+            referenced.add(0)
+            logger.info("Stitched receipt %s from %d photos with %d items", receipt.id, len(uploads), len(items))
+            yield BatchReceiptResult(receipt_id=receipt.id, items_count=len(items)).json() + "\n"
+    finally:
+        # Stops OCR for files nobody is waiting for any more, e.g. after a client disconnect.
+        for task in tasks:
+            task.cancel()
+        reservation.close()
+        for index, upload in enumerate(uploads):
+            if index not in referenced:
+                upload.path.unlink(missing_ok=True)
+
+
+@router.post("/receipts/batch")
+async def upload_receipt_batch(
+    files: list[UploadFile] = File(...), stitch: bool = Form(False)
+) -> StreamingResponse:
+    if len(files) > settings.batch_max_files:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Too many files (max {settings.batch_max_files})"
+        )
+    for file in files:
+        _validate_upload(file)
+    logger.info("Processing receipt batch: files=%d stitch=%s", len(files), stitch)
+    media_root = Path(settings.media_root)
+    uploads: list[SavedUpload] = []
+    # Slots for the whole batch are taken up front, so concurrent batches cannot fail each other file by file.
+    with _ocr_errors():
+        reservation = ocr_pool.reserve(len(files))
+    try:
+        with _ocr_errors():
+            # Uploads are only readable while the request is alive, so all of them are saved before streaming.
+            for file in files:
+                uploads.append(await save_upload(file, media_root))
+    except BaseException:
+        reservation.close()
+        for upload in uploads:
+            upload.path.unlink(missing_ok=True)
+        raise
+    filenames = [file.filename or f"file-{index}" for index, file in enumerate(files)]
+    return StreamingResponse(_stream_batch(filenames, uploads, stitch, reservation), media_type="application/x-ndjson")
+
+
+async def _process_ocr_job(job_id: uuid.UUID, upload: SavedUpload, reservation: OcrReservation) -> None:
+    async def on_stage(stage: str) -> None:
+        await update_job(job_id, OcrJobStage(stage))
+
+    try:
+        with _ocr_errors():
+            try:
+                text, parsed_items = await recognize_image(upload, on_stage=on_stage, reservation=reservation)
+            finally:
+                reservation.close()
+        await update_job(job_id, OcrJobStage.persisting)
+        async with background_session() as session:
+            receipt, items = await _create_draft_receipt(session, upload.path, parsed_items)
+            job = await session.get(OcrJob, job_id)
+            if job is not None:
+                job.stage = OcrJobStage.done
+                job.receipt_id = receipt.id
+                job.updated_at = datetime.utcnow()
+            await session.commit()
+    except HTTPException as exc:
+        upload.path.unlink(missing_ok=True)
+        await update_job(job_id, OcrJobStage.failed, error=str(exc.detail))
+        return
+    except Exception:
+        error_id = uuid.uuid4().hex[:8]
+        logger.exception("OCR job %s failed (error_id=%s)", job_id, error_id)
+        await update_job(job_id, OcrJobStage.failed, error=f"Не удалось обработать чек (код {error_id})")
+        return
+    logger.info(
+        "OCR job %s saved receipt %s with %d parsed items. First characters of OCR text: %s",
+        job_id,
+        receipt.id,
+        len(items),
+        text[:120].replace("\n", "\\n"),
+    )
+    if job is not None:
+        await publish_job(job)
+
+
+@router.post("/receipt-jobs", response_model=OcrJobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def create_receipt_job(file: UploadFile, session: AsyncSession = Depends(get_session)) -> OcrJob:
+    size = _validate_upload(file)
+    logger.info(
+        "Queueing receipt OCR job: filename=%s content_type=%s size_bytes=%s", file.filename, file.content_type, size
+    )
+    # The slot is taken now, so a job that got its 202 is never turned away by the pool later.
+    with _ocr_errors():
+        reservation = ocr_pool.reserve()
+    try:
+        # The upload is only readable while the request is alive, so it is saved before responding.
+        with _ocr_errors():
+            upload = await save_upload(file, Path(settings.media_root))
+        job = OcrJob(image_path=str(upload.path), stage=OcrJobStage.saved)
+        session.add(job)
+        await session.commit()
+    except BaseException:
+        reservation.close()
+        raise
+    spawn_job(_process_ocr_job(job.id, upload, reservation))
+    return job
+
+
+@router.get("/receipt-jobs/{job_id}", response_model=OcrJobResponse)
+async def get_receipt_job(job_id: uuid.UUID, session: AsyncSession = Depends(get_session)) -> OcrJob:
+    job = await session.get(OcrJob, job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+
+@router.get("/ocr/cache", response_model=OcrCacheStats)
+async def get_ocr_cache_stats() -> OcrCacheStats:
+    return OcrCacheStats(**ocr_cache.stats())
+
+
+@router.get("/ws/stats", response_model=WebSocketStats)
+async def get_websocket_stats() -> WebSocketStats:
+    return WebSocketStats(**manager.stats())
+
+
 @router.get("/receipts/{receipt_id}/items", response_model=list[ItemSchema])
-async def get_receipt_items(receipt_id: uuid.UUID, session: AsyncSession = Depends(get_session)) -> list[ItemSchema]:
-    result = await session.execute(select(ReceiptItem).where(ReceiptItem.receipt_id == receipt_id))
-    items = result.scalars().all()
-    if not items:
-        receipt_exists = await session.get(Receipt, receipt_id)
-        if not receipt_exists:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Receipt not found")
-    return list(items)
+async def get_receipt_items(
+    receipt_id: uuid.UUID,
+    if_none_match: str | None = Header(default=None),
+    session: AsyncSession = Depends(get_session),
+) -> Response:
+    revision = await session.scalar(select(Receipt.revision).where(Receipt.id == receipt_id))
+    if revision is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Receipt not found")
+    etag = _revision_etag(receipt_id, revision)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    result = await session.execute(
+        select(
+            ReceiptItem.id, ReceiptItem.name, ReceiptItem.qty_total, ReceiptItem.unit_price, ReceiptItem.amount_total
+        )
+        .where(ReceiptItem.receipt_id == receipt_id)
+        .order_by(ReceiptItem.created_at, ReceiptItem.id)
+    )
+    body = dumps([row._asdict() for row in result])
+    return json_response(body, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def _item_changed(db_item: ReceiptItem, item: ItemDraft) -> bool:
+    return (
+        db_item.name != item.name
+        or db_item.qty_total != item.qty_total
+        or Decimal(db_item.unit_price) != Decimal(str(item.unit_price))
+        or Decimal(db_item.amount_total) != Decimal(str(item.amount_total))
+    )
 
 
 @router.put("/receipts/{receipt_id}/items", response_model=list[ItemSchema])
 async def update_receipt_items(
     receipt_id: uuid.UUID, payload: ItemUpdate, session: AsyncSession = Depends(get_session)
 ) -> list[ItemSchema]:
+    """
+    Apply the reviewed items as a diff.
+
+    Items sent with an ``id`` are updated only if a field differs, items without
+    one are inserted, and stored items missing from the payload are deleted.
+    """
     receipt = await session.get(Receipt, receipt_id)
     if not receipt:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Receipt not found")
     if receipt.status != ReceiptStatus.draft:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Receipt already finalized")
-    item_ids_subquery = select(ReceiptItem.id).where(ReceiptItem.receipt_id == receipt_id)
-    await session.execute(delete(ItemUnit).where(ItemUnit.item_id.in_(item_ids_subquery)))
-    await session.execute(delete(ReceiptItem).where(ReceiptItem.receipt_id == receipt_id))
-    updated_items: list[ReceiptItem] = []
+    result = await session.execute(select(ReceiptItem).where(ReceiptItem.receipt_id == receipt_id))
+    existing = {db_item.id: db_item for db_item in result.scalars()}
+
+    sent_ids = [item.id for item in payload.items if item.id is not None]
+    if len(sent_ids) != len(set(sent_ids)):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Duplicate item id")
+    if any(item_id not in existing for item_id in sent_ids):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown item id")
+
+    to_update: list[dict] = []
+    to_insert: list[dict] = []
+    response: list[ItemSchema] = []
     for item in payload.items:
-        db_item = ReceiptItem(
-            receipt_id=receipt_id,
-            name=item.name,
-            qty_total=item.qty_total,
-            unit_price=item.unit_price,
-            amount_total=item.amount_total,
-        )
-        session.add(db_item)
-        updated_items.append(db_item)
+        values = item.dict(exclude={"id"})
+        if item.id is None:
+            row = {"id": uuid.uuid4(), "receipt_id": receipt_id, **values}
+            to_insert.append(row)
+        else:
+            row = {"id": item.id, **values}
+            if _item_changed(existing[item.id], item):
+                to_update.append(row)
+        response.append(ItemSchema(**row))
+    to_delete = existing.keys() - set(sent_ids)
+
+    if to_delete:
+        await session.execute(delete(ReceiptItem).where(ReceiptItem.id.in_(to_delete)))
+    if to_update:
+        await session.execute(update(ReceiptItem), to_update)
+    if to_insert:
+        await session.execute(insert(ReceiptItem), to_insert)
+    if to_delete or to_update or to_insert:
+        receipt.revision += 1
     await session.commit()
-    return updated_items
+    return response
 
 
 @router.post("/receipts/{receipt_id}/finalize", response_model=FinalizeResponse)
@@ -176,18 +453,20 @@ async def finalize_receipt(
     token = secrets.token_urlsafe(16)
     receipt.token = token
     receipt.status = ReceiptStatus.open
+    receipt.revision += 1
 
-    result = await session.execute(select(ReceiptItem).where(ReceiptItem.receipt_id == receipt_id))
-    items = result.scalars().all()
-    for item in items:
-        for idx in range(item.qty_total):
-            unit = ItemUnit(
-                item_id=item.id,
-                unit_index=idx,
-                amount_total=item.unit_price,
-                amount_paid=Decimal("0.00"),
-            )
-            session.add(unit)
+    # One statement for every unit of every item; amount_paid and status take their server defaults.
+    unit_index = func.generate_series(0, ReceiptItem.qty_total - 1).column_valued("unit_index")
+    created = await session.execute(
+        insert(ItemUnit).from_select(
+            ["id", "item_id", "unit_index", "amount_total"],
+            select(func.gen_random_uuid(), ReceiptItem.id, unit_index, ReceiptItem.unit_price).where(
+                ReceiptItem.receipt_id == receipt_id
+            ),
+            include_defaults=False,
+        )
+    )
+    receipt.units_total = created.rowcount
 
     await session.commit()
     room_url = str(request.url_for("room_page", token=token))
@@ -195,39 +474,80 @@ async def finalize_receipt(
 
 
 @router.get("/receipts/{token}", response_model=ReceiptRoomResponse)
-async def get_room(token: str, session: AsyncSession = Depends(get_session)) -> ReceiptRoomResponse:
-    receipt_result = await session.execute(select(Receipt).where(Receipt.token == token))
-    receipt = receipt_result.scalar_one_or_none()
-    if not receipt:
+async def get_room(
+    token: str,
+    if_none_match: str | None = Header(default=None),
+    session: AsyncSession = Depends(get_session),
+) -> Response:
+    current = await room_snapshots.lookup(session, token)
+    if current is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Receipt not found")
-    items_result = await session.execute(select(ReceiptItem).where(ReceiptItem.receipt_id == receipt.id))
-    items = items_result.scalars().all()
-    for item in items:
-        await session.refresh(item, attribute_names=["units"])
-    payments_result = await session.execute(
-        select(Payment).where(Payment.receipt_id == receipt.id).order_by(Payment.created_at.desc())
+    receipt_id, revision = current
+    etag = _revision_etag(receipt_id, revision)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    snapshot = await room_snapshots.get(session, token, receipt_id, revision)
+    # The snapshot may already be newer than the revision we looked up; label the body with its own revision.
+    # The body is encoded once per revision, so a refetch only copies bytes.
+    return json_response(
+        snapshot.body, headers={"ETag": _revision_etag(receipt_id, snapshot.revision), "Cache-Control": "no-cache"}
     )
-    payments = payments_result.scalars().all()
-    return ReceiptRoomResponse(
-        token=token, status=receipt.status, items=items, payments=payments, created_at=receipt.created_at
+
+
+def _payment_delta(result: PaymentResult, payer_name: str) -> dict:
+    delta = PaymentDelta(
+        seq=result.receipt.revision,
+        payer=payer_name,
+        receipt_status=result.receipt.status,
+        units_total=result.receipt.units_total,
+        units_paid=result.receipt.units_paid,
+        amount_paid=result.receipt.amount_paid,
+        items=result.items,
+        units=list(result.units.values()),
+        payments=result.payments,
     )
+    return jsonable_encoder(delta)
 
 
-@router.post("/receipts/{token}/pay")
+@router.post("/receipts/{token}/pay", response_model=PaymentResponse)
 async def pay_receipt(
-    token: str, payload: PaymentRequest, session: AsyncSession = Depends(get_session)
-):
+    token: str,
+    payload: PaymentRequest,
+    background_tasks: BackgroundTasks,
+    idempotency_key: str | None = Header(default=None),
+    session: AsyncSession = Depends(get_session),
+) -> PaymentResponse:
+    if idempotency_key is not None:
+        if not idempotency_key or len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Idempotency-Key")
+        fingerprint = request_fingerprint(payload.dict())
+        stored = await claim_key(session, token, idempotency_key, fingerprint)
+        if stored is not None:
+            # A retry of a payment that already went through: replay it without touching any locks.
+            await session.rollback()
+            if stored.request_hash != fingerprint:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="Idempotency-Key was already used with a different request",
+                )
+            return PaymentResponse(**stored.response)
     try:
-        await process_payment_lines(
+        result = await process_payment_lines(
             session,
             token=token,
             payer_name=payload.payer_name,
             lines=[line.dict() for line in payload.lines],
         )
+        response = PaymentResponse(status="ok", seq=result.receipt.revision)
+        if idempotency_key is not None:
+            await store_response(session, result.receipt.id, idempotency_key, response.dict())
         await session.commit()
-        await manager.broadcast(token, {"type": "payment", "payer": payload.payer_name})
+        room_snapshots.invalidate(token)
+        # Fan-out runs after the response is sent, so the payer never waits for other sockets.
+        background_tasks.add_task(manager.broadcast, token, _payment_delta(result, payload.payer_name))
     except PaymentError as exc:
+        # Rolling back releases the key too, so a retry of a failed payment is evaluated afresh.
         await session.rollback()
         status_code = status.HTTP_409_CONFLICT if "exceed" in str(exc).lower() else status.HTTP_400_BAD_REQUEST
         raise HTTPException(status_code=status_code, detail=str(exc))
-    return {"status": "ok"}
+    return response
@@ -1,6 +1,8 @@
 import os
 from functools import lru_cache
 
+from typing import Literal
+
 from pydantic import BaseSettings, Field, HttpUrl
 
 
@@ -8,11 +10,47 @@ class Settings(BaseSettings):
     app_name: str = "Receipt Splitter"
     environment: str = Field("development", env="ENVIRONMENT")
     database_url: str = Field("postgresql+asyncpg://postgres:postgres@db:5432/postgres", env="DATABASE_URL")
+    # LISTEN needs a session-level connection; set this when DATABASE_URL points at pgbouncer.
+    database_direct_url: str | None = Field(default=None, env="DATABASE_DIRECT_URL")
+    db_pool_size: int = Field(10, env="DB_POOL_SIZE")
+    db_max_overflow: int = Field(5, env="DB_MAX_OVERFLOW")
+    db_pool_timeout_seconds: float = Field(10.0, env="DB_POOL_TIMEOUT_SECONDS")
+    db_pool_recycle_seconds: int = Field(1800, env="DB_POOL_RECYCLE_SECONDS")
+    db_pool_pre_ping: bool = Field(True, env="DB_POOL_PRE_PING")
+    db_background_pool_size: int = Field(2, env="DB_BACKGROUND_POOL_SIZE")
+    db_background_max_overflow: int = Field(3, env="DB_BACKGROUND_MAX_OVERFLOW")
+    db_statement_cache_size: int = Field(256, env="DB_STATEMENT_CACHE_SIZE")
+    db_pgbouncer: bool = Field(False, env="DB_PGBOUNCER")
     media_root: str = Field("media", env="MEDIA_ROOT")
     tesseract_cmd: str | None = Field(default=None, env="TESSERACT_CMD")
     allowed_origins: list[HttpUrl] = Field(default_factory=list, env="ALLOWED_ORIGINS")
     upload_max_mb: int = Field(20, env="UPLOAD_MAX_MB")
+    batch_max_files: int = Field(10, env="BATCH_MAX_FILES")
     gunicorn_workers: int = Field(3, env="GUNICORN_WORKERS")
+    websocket_broker: Literal["memory", "postgres"] = Field("memory", env="WEBSOCKET_BROKER")
+    ws_send_timeout_seconds: float = Field(5.0, env="WS_SEND_TIMEOUT_SECONDS")
+    ws_outbox_size: int = Field(16, env="WS_OUTBOX_SIZE")
+    ws_coalesce_ms: int = Field(75, env="WS_COALESCE_MS")
+    ws_ping_interval_seconds: float = Field(25.0, env="WS_PING_INTERVAL_SECONDS")
+    ws_idle_timeout_seconds: float = Field(60.0, env="WS_IDLE_TIMEOUT_SECONDS")
+    ws_max_connections: int = Field(5000, env="WS_MAX_CONNECTIONS")
+    ws_max_connections_per_room: int = Field(50, env="WS_MAX_CONNECTIONS_PER_ROOM")
+    room_snapshot_cache_size: int = Field(1000, env="ROOM_SNAPSHOT_CACHE_SIZE")
+    payment_idempotency_ttl_hours: int = Field(24, env="PAYMENT_IDEMPOTENCY_TTL_HOURS")
+    ocr_backend: Literal["pytesseract", "tesserocr"] = Field("pytesseract", env="OCR_BACKEND")
+    ocr_engine_pool_size: int | None = Field(default=None, env="OCR_ENGINE_POOL_SIZE")
+    ocr_executor: Literal["thread", "process"] = Field("thread", env="OCR_EXECUTOR")
+    ocr_workers: int = Field(2, env="OCR_WORKERS")
+    ocr_queue_size: int = Field(8, env="OCR_QUEUE_SIZE")
+    ocr_timeout_seconds: float = Field(60.0, env="OCR_TIMEOUT_SECONDS")
+    ocr_retry_after_seconds: int = Field(5, env="OCR_RETRY_AFTER_SECONDS")
+    ocr_target_width: int = Field(1200, env="OCR_TARGET_WIDTH")
+    ocr_crop_paper: bool = Field(True, env="OCR_CROP_PAPER")
+    ocr_max_skew_degrees: float = Field(10.0, env="OCR_MAX_SKEW_DEGREES")
+    ocr_cache_enabled: bool = Field(True, env="OCR_CACHE_ENABLED")
+    ocr_cache_dir: str | None = Field(default=None, env="OCR_CACHE_DIR")
+    ocr_cache_ttl_seconds: int = Field(7 * 24 * 3600, env="OCR_CACHE_TTL_SECONDS")
+    ocr_cache_max_mb: int = Field(200, env="OCR_CACHE_MAX_MB")
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,33 @@
+"""
+orjson encoding for the hot read endpoints.
+
+Their bodies are plain dicts built from query rows and encoded once, without
+pydantic validation or ``jsonable_encoder``. ``Numeric`` columns arrive as
+``Decimal`` and are written as JSON numbers, like the ``float`` fields of the
+schemas did; with two decimal places the shortest float repr is the stored
+value. UUIDs, datetimes and enums are encoded natively by orjson, in the same
+form as before.
+"""
+
+from __future__ import annotations
+
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from fastapi import Response
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default)
+
+
+def json_response(body: bytes, headers: dict[str, str] | None = None) -> Response:
+    """Response for an already encoded body; FastAPI skips ``response_model`` validation for it."""
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,163 @@
+"""
+Prometheus metrics for the app.
+
+Under gunicorn each worker writes its samples to files in
+``PROMETHEUS_MULTIPROC_DIR`` (scripts/start.sh sets it up and the gunicorn
+config marks dead workers), and ``/metrics`` merges the files of all workers,
+so whichever worker answers the scrape reports the whole instance. Without
+the variable, e.g. under ``uvicorn --reload``, the in-process registry is used.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from contextvars import ContextVar
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import QueuePool
+
+
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+OCR_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Request latency by route", ["method", "route", "status"], buckets=REQUEST_BUCKETS
+)
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Time spent in database statements per request", ["method", "route"], buckets=FAST_BUCKETS
+)
+HTTP_REQUEST_DB_STATEMENTS = Histogram(
+    "http_request_db_statements",
+    "Database statements per request",
+    ["method", "route"],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+)
+OCR_STAGE_SECONDS = Histogram("ocr_stage_seconds", "OCR pipeline stage duration", ["stage"], buckets=OCR_BUCKETS)
+OCR_PREPROCESS_STEP_SECONDS = Histogram(
+    "ocr_preprocess_step_seconds", "Preprocessing step duration", ["step"], buckets=FAST_BUCKETS
+)
+OCR_CACHE_LOOKUPS = Counter("ocr_cache_lookups", "OCR cache lookups by result", ["result"])
+RECEIPT_LOCK_WAIT_SECONDS = Histogram(
+    "payment_receipt_lock_wait_seconds", "Wait for the receipt row lock in a payment", buckets=FAST_BUCKETS
+)
+RECEIPT_LOCK_HOLD_SECONDS = Histogram(
+    "payment_receipt_lock_hold_seconds", "Receipt row lock held until commit or rollback", buckets=FAST_BUCKETS
+)
+WS_BROADCAST_SECONDS = Histogram(
+    "ws_broadcast_seconds", "Broadcast latency: broker publish, and fan-out to local sockets", ["stage"], buckets=FAST_BUCKETS
+)
+WS_MESSAGES = Counter("ws_messages", "Room messages delivered to this worker")
+WS_FRAMES = Counter("ws_frames", "Frames fanned out after coalescing")
+WS_CONNECTIONS = Gauge("ws_connections", "Open WebSocket connections", multiprocess_mode="liveall")
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "SQLAlchemy pool connections by state", ["pool", "state"], multiprocess_mode="liveall"
+)
+DB_POOL_TIMEOUTS = Counter("db_pool_timeouts", "Requests rejected because no pooled connection freed up in time")
+
+_db_time: ContextVar[list | None] = ContextVar("db_time", default=None)
+# (name, pool) of every instrumented QueuePool in this process.
+_pools: list[tuple[str, QueuePool]] = []
+
+
+def render_metrics() -> bytes:
+    refresh_pool_gauges()
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def instrument_engine(engine: AsyncEngine, name: str) -> None:
+    """Count statement time into the current request and keep the gauges of pool ``name`` current."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        started = conn.info["query_started"].pop()
+        totals = _db_time.get()
+        if totals is not None:
+            totals[0] += time.perf_counter() - started
+            totals[1] += 1
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(context) -> None:
+        if context.connection is not None and context.connection.info.get("query_started"):
+            context.connection.info["query_started"].pop()
+
+    pool = sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        # NullPool in pgbouncer mode: there is nothing to saturate on our side.
+        return
+    # Saturation is checked_out / capacity; at capacity new requests wait up to DB_POOL_TIMEOUT_SECONDS.
+    DB_POOL_CONNECTIONS.labels(name, "capacity").set(pool.size() + pool._max_overflow)
+    _pools.append((name, pool))
+    refresh_pool_gauges()
+
+
+def refresh_pool_gauges() -> None:
+    """
+    Read the state of this worker's pools into the gauges.
+
+    Pool events are no use here: ``checkin`` fires before the connection is
+    back in the pool, so gauges set from it lag one event behind and an idle
+    app looks saturated. The gauges are read instead on every scrape and after
+    every request, which leaves each worker's file current once it goes idle.
+    """
+    for name, pool in _pools:
+        DB_POOL_CONNECTIONS.labels(name, "checked_out").set(pool.checkedout())
+        DB_POOL_CONNECTIONS.labels(name, "idle").set(pool.checkedin())
+        DB_POOL_CONNECTIONS.labels(name, "overflow").set(max(0, pool.overflow()))
+        DB_POOL_CONNECTIONS.labels(name, "size").set(pool.size())
+
+
+class RequestMetricsMiddleware:
+    """Plain ASGI middleware: route latency plus the DB time and statements spent inside the request."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        totals = [0.0, 0]
+        token = _db_time.set(totals)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _db_time.reset(token)
+            # FastAPI stores the matched route in the scope; the template keeps label cardinality bounded.
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUEST_SECONDS.labels(method, route, str(status_code)).observe(time.perf_counter() - started)
+            HTTP_REQUEST_DB_SECONDS.labels(method, route).observe(totals[0])
+            HTTP_REQUEST_DB_STATEMENTS.labels(method, route).observe(totals[1])
+            # Request-scoped sessions are closed by now, so their connections count as idle again.
+            refresh_pool_gauges()
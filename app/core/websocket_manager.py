@@ -1,32 +1,410 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import logging
+import time
 from collections import defaultdict
-from typing import DefaultDict
+from collections.abc import Awaitable, Callable
+from typing import DefaultDict, Protocol
 
+import asyncpg
 from fastapi import WebSocket
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
 
+from app.core.config import Settings, get_settings
+from app.core.metrics import WS_BROADCAST_SECONDS, WS_CONNECTIONS, WS_FRAMES, WS_MESSAGES
+from app.db import background_engine
+
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, dict], Awaitable[None]]
+OnReconnect = Callable[[], Awaitable[None]]
+
+NOTIFY_CHANNEL = "room_events"
+# Postgres rejects NOTIFY payloads of 8000 bytes or more.
+NOTIFY_MAX_PAYLOAD = 7900
+LISTENER_HEALTHCHECK_SECONDS = 30.0
+LISTENER_MAX_BACKOFF_SECONDS = 30.0
+RESYNC_FRAME = json.dumps({"type": "resync"})
+PING_FRAME = json.dumps({"type": "ping"})
+# 1013 "Try Again Later": the client should back off before reconnecting.
+CLOSE_TRY_AGAIN_LATER = 1013
+CLOSE_GOING_AWAY = 1001
+
+
+class Broker(Protocol):
+    async def start(self, deliver: Deliver, on_reconnect: OnReconnect) -> None: ...
+
+    async def publish(self, token: str, message: dict) -> None: ...
+
+    async def stop(self) -> None: ...
+
+
+class InProcessBroker:
+    """Delivers messages only to sockets of the current process; enough for a single worker."""
+
+    def __init__(self) -> None:
+        self._deliver: Deliver | None = None
+
+    async def start(self, deliver: Deliver, on_reconnect: OnReconnect) -> None:
+        self._deliver = deliver
+
+    async def publish(self, token: str, message: dict) -> None:
+        if self._deliver is not None:
+            await self._deliver(token, message)
+
+    async def stop(self) -> None:
+        self._deliver = None
+
+
+class PostgresBroker:
+    """
+    Fans messages out to every worker through Postgres LISTEN/NOTIFY.
+
+    Each process keeps one dedicated asyncpg connection that LISTENs on
+    ``NOTIFY_CHANNEL`` and hands notifications to the local sockets. Publishing
+    goes through the background SQLAlchemy pool. Notifications sent while the
+    listener is reconnecting are lost, so after a reconnect every local room is
+    told to resync.
+    """
+
+    def __init__(self, database_url: str) -> None:
+        self.database_url = database_url
+        self.dsn = make_url(database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self._deliver: Deliver | None = None
+        self._listener: asyncio.Task | None = None
+        self._deliveries: set[asyncio.Task] = set()
+        self._on_reconnect: OnReconnect | None = None
+
+    async def start(self, deliver: Deliver, on_reconnect: OnReconnect) -> None:
+        self._deliver = deliver
+        self._on_reconnect = on_reconnect
+        self._listener = asyncio.create_task(self._listen_forever())
+
+    async def publish(self, token: str, message: dict) -> None:
+        payload = json.dumps({"token": token, "message": message}, separators=(",", ":"))
+        if len(payload.encode()) > NOTIFY_MAX_PAYLOAD:
+            payload = json.dumps({"token": token, "message": {"type": "resync", "seq": message.get("seq")}})
+        async with background_engine.connect() as connection:
+            await connection.execute(
+                text("SELECT pg_notify(:channel, :payload)"), {"channel": NOTIFY_CHANNEL, "payload": payload}
+            )
+            await connection.commit()
+
+    def _on_notify(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        if self._deliver is None:
+            return
+        try:
+            envelope = json.loads(payload)
+        except ValueError:
+            logger.warning("Ignoring malformed notification on %s", channel)
+            return
+        task = asyncio.create_task(self._deliver(envelope["token"], envelope["message"]))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _listen_forever(self) -> None:
+        backoff = 1.0
+        connected_before = False
+        while True:
+            connection: asyncpg.Connection | None = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                connection.add_termination_listener(lambda _: lost.set())
+                await connection.add_listener(NOTIFY_CHANNEL, self._on_notify)
+                logger.info("Listening for room events on %s", NOTIFY_CHANNEL)
+                backoff = 1.0
+                if connected_before and self._on_reconnect is not None:
+                    await self._on_reconnect()
+                connected_before = True
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), timeout=LISTENER_HEALTHCHECK_SECONDS)
+                    except asyncio.TimeoutError:
+                        await asyncio.wait_for(connection.execute("SELECT 1"), timeout=LISTENER_HEALTHCHECK_SECONDS)
+                logger.warning("Room event listener connection closed, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Room event listener failed, retrying in %.0fs", backoff, exc_info=True)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, LISTENER_MAX_BACKOFF_SECONDS)
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close(timeout=5)
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        self._deliver = None
+
+
+def create_broker(settings: Settings) -> Broker:
+    if settings.websocket_broker == "postgres":
+        return PostgresBroker(settings.database_direct_url or settings.database_url)
+    return InProcessBroker()
+
+
+class RoomConnection:
+    """
+    One socket with its own bounded outbox and sender task.
+
+    Frames are queued without waiting; the sender writes them one at a time,
+    each bounded by ``send_timeout``. A consumer whose outbox fills up gets its
+    backlog replaced by a single resync frame, and one that cannot take a frame
+    within the timeout is closed and dropped.
+    """
+
+    __slots__ = ("token", "websocket", "outbox", "sender", "last_seen")
+
+    def __init__(self, token: str, websocket: WebSocket, outbox_size: int) -> None:
+        self.token = token
+        self.websocket = websocket
+        self.outbox: asyncio.Queue[str] = asyncio.Queue(maxsize=max(1, outbox_size))
+        self.sender: asyncio.Task | None = None
+        self.last_seen = time.monotonic()
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+    def offer(self, frame: str) -> None:
+        try:
+            self.outbox.put_nowait(frame)
+        except asyncio.QueueFull:
+            while not self.outbox.empty():
+                self.outbox.get_nowait()
+            self.outbox.put_nowait(RESYNC_FRAME)
+
+
+class RoomStats:
+    __slots__ = ("messages", "frames", "since")
 
-class ConnectionManager:
     def __init__(self) -> None:
-        self.active_connections: DefaultDict[str, set[WebSocket]] = defaultdict(set)
+        self.messages = 0
+        self.frames = 0
+        self.since = time.monotonic()
+
+
+class ConnectionManager:
+    """
+    Room sockets of this process.
+
+    With a positive ``coalesce_window`` (seconds) the first message for a room
+    starts a timer; everything that arrives for that room before it fires is
+    sent as one ``{"type": "batch", "messages": [...]}`` frame, serialised once.
 
-    async def connect(self, token: str, websocket: WebSocket) -> None:
+    A single heartbeat task pings every socket each ``ping_interval`` and closes
+    the ones that have not sent anything for ``idle_timeout``; clients answer
+    pings with ``{"type": "pong"}``. ``max_connections`` and
+    ``max_connections_per_room`` cap what one process accepts.
+    """
+
+    def __init__(
+        self,
+        broker: Broker | None = None,
+        send_timeout: float = 5.0,
+        outbox_size: int = 16,
+        coalesce_window: float = 0.0,
+        ping_interval: float = 25.0,
+        idle_timeout: float = 60.0,
+        max_connections: int = 5000,
+        max_connections_per_room: int = 50,
+    ) -> None:
+        self.active_connections: DefaultDict[str, dict[WebSocket, RoomConnection]] = defaultdict(dict)
+        self.broker = broker or InProcessBroker()
+        self.send_timeout = send_timeout
+        self.outbox_size = outbox_size
+        self.coalesce_window = coalesce_window
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.max_connections_per_room = max_connections_per_room
+        self.connection_count = 0
+        self.rejected_total = 0
+        self.reaped_total = 0
+        self._heartbeat: asyncio.Task | None = None
+        self._closing: set[asyncio.Task] = set()
+        self.messages_total = 0
+        self.frames_total = 0
+        self._pending: dict[str, list[dict]] = {}
+        self._room_stats: dict[str, RoomStats] = {}
+
+    async def start(self) -> None:
+        await self.broker.start(self.deliver, self.resync_all)
+        if self.ping_interval > 0:
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+            self._heartbeat = None
+        await self.broker.stop()
+
+    async def connect(self, token: str, websocket: WebSocket) -> RoomConnection | None:
+        """Accept the socket, or accept and close it with 1013 when a limit is reached."""
         await websocket.accept()
-        self.active_connections[token].add(websocket)
+        room_size = len(self.active_connections.get(token, ()))
+        if self.connection_count >= self.max_connections or room_size >= self.max_connections_per_room:
+            self.rejected_total += 1
+            logger.info(
+                "Rejecting WebSocket: %s connections in process, %s in room", self.connection_count, room_size
+            )
+            await websocket.close(code=CLOSE_TRY_AGAIN_LATER)
+            return None
+        connection = RoomConnection(token, websocket, self.outbox_size)
+        connection.sender = asyncio.create_task(self._send_loop(connection))
+        self.active_connections[token][websocket] = connection
+        self.connection_count += 1
+        WS_CONNECTIONS.set(self.connection_count)
+        self._room_stats.setdefault(token, RoomStats())
+        return connection
 
     def disconnect(self, token: str, websocket: WebSocket) -> None:
-        if websocket in self.active_connections.get(token, set()):
-            self.active_connections[token].remove(websocket)
-        if not self.active_connections[token]:
+        connections = self.active_connections.get(token)
+        if connections is None:
+            return
+        connection = connections.pop(websocket, None)
+        if connection is not None:
+            self.connection_count -= 1
+            WS_CONNECTIONS.set(self.connection_count)
+        sender = connection.sender if connection is not None else None
+        if sender is not None and sender is not asyncio.current_task():
+            sender.cancel()
+        if not connections:
             self.active_connections.pop(token, None)
+            self._room_stats.pop(token, None)
 
     async def broadcast(self, token: str, message: dict) -> None:
-        for connection in list(self.active_connections.get(token, set())):
-            try:
-                await connection.send_json(message)
-            except Exception:
-                self.disconnect(token, connection)
+        started = time.perf_counter()
+        await self.broker.publish(token, message)
+        WS_BROADCAST_SECONDS.labels("publish").observe(time.perf_counter() - started)
+
+    def send(self, token: str, websocket: WebSocket, message: dict) -> None:
+        connection = self.active_connections.get(token, {}).get(websocket)
+        if connection is not None:
+            connection.offer(json.dumps(message))
+
+    async def deliver(self, token: str, message: dict) -> None:
+        if token not in self.active_connections:
+            return
+        self.messages_total += 1
+        WS_MESSAGES.inc()
+        self._room_stats.setdefault(token, RoomStats()).messages += 1
+        if self.coalesce_window <= 0:
+            self._send_frame(token, json.dumps(message))
+            return
+        pending = self._pending.get(token)
+        if pending is None:
+            self._pending[token] = [message]
+            asyncio.get_running_loop().call_later(self.coalesce_window, self._flush, token)
+        else:
+            pending.append(message)
+
+    def _flush(self, token: str) -> None:
+        messages = self._pending.pop(token, None)
+        if not messages:
+            return
+        if len(messages) == 1:
+            frame = json.dumps(messages[0])
+        else:
+            frame = json.dumps({"type": "batch", "messages": messages})
+        self._send_frame(token, frame)
+
+    def _send_frame(self, token: str, frame: str) -> None:
+        connections = self.active_connections.get(token)
+        if not connections:
+            return
+        started = time.perf_counter()
+        self.frames_total += 1
+        WS_FRAMES.inc()
+        stats = self._room_stats.get(token)
+        if stats is not None:
+            stats.frames += 1
+        for connection in list(connections.values()):
+            connection.offer(frame)
+        WS_BROADCAST_SECONDS.labels("fanout").observe(time.perf_counter() - started)
+
+    def stats(self, top: int = 10) -> dict:
+        """Process-local delivery counters; room tokens are left out because they grant access to the room."""
+        now = time.monotonic()
+        rooms = sorted(
+            (
+                {
+                    "connections": len(self.active_connections.get(token, ())),
+                    "messages": room.messages,
+                    "frames": room.frames,
+                    "messages_per_second": round(room.messages / max(now - room.since, 1.0), 3),
+                }
+                for token, room in self._room_stats.items()
+            ),
+            key=lambda room: room["messages_per_second"],
+            reverse=True,
+        )
+        return {
+            "rooms": len(self.active_connections),
+            "connections": self.connection_count,
+            "rejected": self.rejected_total,
+            "reaped": self.reaped_total,
+            "messages": self.messages_total,
+            "frames": self.frames_total,
+            "coalescing_ratio": round(self.messages_total / self.frames_total, 3) if self.frames_total else 1.0,
+            "busiest_rooms": rooms[:top],
+        }
+
+    async def _send_loop(self, connection: RoomConnection) -> None:
+        try:
+            while True:
+                frame = await connection.outbox.get()
+                await asyncio.wait_for(connection.websocket.send_text(frame), timeout=self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            if isinstance(exc, asyncio.TimeoutError):
+                logger.info("Dropping slow WebSocket consumer in room %s", connection.token)
+            self.disconnect(connection.token, connection.websocket)
+            await self._close(connection.websocket, CLOSE_TRY_AGAIN_LATER)
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            deadline = time.monotonic() - self.idle_timeout
+            for connections in list(self.active_connections.values()):
+                for connection in list(connections.values()):
+                    if connection.last_seen < deadline:
+                        self.reaped_total += 1
+                        self.disconnect(connection.token, connection.websocket)
+                        task = asyncio.create_task(self._close(connection.websocket, CLOSE_GOING_AWAY))
+                        self._closing.add(task)
+                        task.add_done_callback(self._closing.discard)
+                    else:
+                        connection.offer(PING_FRAME)
+
+    async def _close(self, websocket: WebSocket, code: int) -> None:
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=self.send_timeout)
+        except Exception:
+            pass
 
+    async def resync_all(self) -> None:
+        for token in list(self.active_connections):
+            await self.deliver(token, {"type": "resync"})
 
-manager = ConnectionManager()
 
+settings = get_settings()
+manager = ConnectionManager(
+    create_broker(settings),
+    send_timeout=settings.ws_send_timeout_seconds,
+    outbox_size=settings.ws_outbox_size,
+    coalesce_window=settings.ws_coalesce_ms / 1000,
+    ping_interval=settings.ws_ping_interval_seconds,
+    idle_timeout=settings.ws_idle_timeout_seconds,
+    max_connections=settings.ws_max_connections,
+    max_connections_per_room=settings.ws_max_connections_per_room,
+)
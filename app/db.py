@@ -1,16 +1,65 @@
 from collections.abc import AsyncIterator
+from uuid import uuid4
 
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 
-from app.core.config import get_settings
+from app.core.config import Settings, get_settings
+from app.core.metrics import instrument_engine
 
 
 settings = get_settings()
-engine = create_async_engine(settings.database_url, echo=False, future=True)
+
+
+def _unique_statement_name() -> str:
+    return f"__asyncpg_{uuid4()}__"
+
+
+def build_engine(settings: Settings, pool_size: int, max_overflow: int) -> AsyncEngine:
+    """
+    Engine with the pool and prepared statement settings from ``settings``.
+
+    Behind pgbouncer in transaction mode consecutive transactions may run on
+    different server connections, so prepared statements are never cached or
+    reused by name, and pooling is left to pgbouncer.
+    """
+    if settings.db_pgbouncer:
+        return create_async_engine(
+            settings.database_url,
+            poolclass=NullPool,
+            connect_args={
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": _unique_statement_name,
+            },
+        )
+    return create_async_engine(
+        settings.database_url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.db_pool_timeout_seconds,
+        pool_recycle=settings.db_pool_recycle_seconds,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        connect_args={"prepared_statement_cache_size": settings.db_statement_cache_size},
+    )
+
+
+# Request handlers use ``engine``; NOTIFY publishing, OCR jobs and periodic
+# cleanup use the small ``background_engine``, so a burst of background work
+# cannot take connections requests are waiting for.
+engine = build_engine(settings, settings.db_pool_size, settings.db_max_overflow)
+background_engine = build_engine(settings, settings.db_background_pool_size, settings.db_background_max_overflow)
+instrument_engine(engine, "main")
+instrument_engine(background_engine, "background")
 async_session = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+background_session = async_sessionmaker(background_engine, expire_on_commit=False, class_=AsyncSession)
 
 
 async def get_session() -> AsyncIterator[AsyncSession]:
     async with async_session() as session:
         yield session
 
+
+async def dispose_engines() -> None:
+    await engine.dispose()
+    await background_engine.dispose()
@@ -1,26 +1,35 @@
 from __future__ import annotations
 
+import logging
+import uuid
 from pathlib import Path
 
 from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import select
+from sqlalchemy import exc, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.api import receipts as receipts_router
 from app.core.config import get_settings
 from app.core.logging_config import setup_logging
-from app.core.websocket_manager import manager
-from app.db import get_session
-from app.models import Receipt, ReceiptStatus
+from app.core.metrics import CONTENT_TYPE_LATEST, DB_POOL_TIMEOUTS, RequestMetricsMiddleware, render_metrics
+from app.core.websocket_manager import RoomConnection, manager
+from app.db import async_session, dispose_engines, get_session
+from app.models import OcrJob, Receipt, ReceiptStatus
 from app.schemas import HealthResponse, ReceiptRoomResponse
+from app.services.idempotency import start_purging, stop_purging
+from app.services.ocr_jobs import cancel_running_jobs, job_channel, job_message
+from app.services.ocr_pool import ocr_pool
 
 
 setup_logging()
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+DB_RETRY_AFTER_SECONDS = 1
 
 BASE_DIR = Path(__file__).resolve().parent
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
@@ -28,6 +37,7 @@ media_root = Path(settings.media_root)
 media_root.mkdir(parents=True, exist_ok=True)
 
 app = FastAPI(title=settings.app_name)
+app.add_middleware(RequestMetricsMiddleware)
 
 if settings.allowed_origins:
     app.add_middleware(
@@ -41,6 +51,37 @@ if settings.allowed_origins:
 
 app.include_router(receipts_router.router)
 
+
+@app.exception_handler(exc.TimeoutError)
+async def database_pool_timeout(request: Request, error: exc.TimeoutError) -> JSONResponse:
+    # Every pooled connection stayed busy for DB_POOL_TIMEOUT_SECONDS: shed the request instead of queueing more.
+    DB_POOL_TIMEOUTS.inc()
+    logger.warning("No database connection available for %s %s: %s", request.method, request.url.path, error)
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Сервер перегружен, повторите попытку позже"},
+        headers={"Retry-After": str(DB_RETRY_AFTER_SECONDS)},
+    )
+
+
+@app.on_event("startup")
+async def start_websocket_broker() -> None:
+    await manager.start()
+
+
+@app.on_event("startup")
+async def start_idempotency_key_purging() -> None:
+    start_purging()
+
+
+@app.on_event("shutdown")
+async def shutdown_background_work() -> None:
+    await cancel_running_jobs()
+    await stop_purging()
+    ocr_pool.shutdown()
+    await manager.stop()
+    await dispose_engines()
+
 static_path = BASE_DIR / "static"
 app.mount("/static", StaticFiles(directory=static_path), name="static")
 
@@ -78,11 +119,44 @@ async def health() -> HealthResponse:
     return HealthResponse(status="ok")
 
 
-@app.websocket("/ws/rooms/{token}")
-async def websocket_endpoint(token: str, websocket: WebSocket, session: AsyncSession = Depends(get_session)) -> None:
-    await manager.connect(token, websocket)
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
+async def _receive_until_closed(connection: RoomConnection) -> None:
+    # Clients only send pongs; any frame counts as a sign of life for the heartbeat.
     try:
         while True:
-            await websocket.receive_text()
+            await connection.websocket.receive_text()
+            connection.touch()
     except WebSocketDisconnect:
-        manager.disconnect(token, websocket)
+        pass
+    finally:
+        manager.disconnect(connection.token, connection.websocket)
+
+
+@app.websocket("/ws/rooms/{token}")
+async def websocket_endpoint(token: str, websocket: WebSocket) -> None:
+    # No DB session here: it would pin a pool connection for the whole lifetime of the socket.
+    connection = await manager.connect(token, websocket)
+    if connection is not None:
+        await _receive_until_closed(connection)
+
+
+@app.websocket("/ws/jobs/{job_id}")
+async def job_websocket_endpoint(job_id: uuid.UUID, websocket: WebSocket) -> None:
+    channel = job_channel(job_id)
+    connection = await manager.connect(channel, websocket)
+    if connection is None:
+        return
+    try:
+        # Send the current state so a client that subscribes late does not miss finished stages.
+        async with async_session() as session:
+            job = await session.get(OcrJob, job_id)
+    except Exception:
+        manager.disconnect(channel, websocket)
+        raise
+    if job is not None:
+        manager.send(channel, websocket, job_message(job))
+    await _receive_until_closed(connection)
@@ -2,8 +2,8 @@ import enum
 import uuid
 from datetime import datetime
 
-from sqlalchemy import CheckConstraint, DateTime, Enum, ForeignKey, Numeric, String, UniqueConstraint
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import CheckConstraint, DateTime, Enum, ForeignKey, Index, Integer, Numeric, String, UniqueConstraint, text
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -23,6 +23,16 @@ class UnitStatus(str, enum.Enum):
     paid = "paid"
 
 
+class OcrJobStage(str, enum.Enum):
+    saved = "saved"
+    preprocessing = "preprocessing"
+    recognizing = "recognizing"
+    parsing = "parsing"
+    persisting = "persisting"
+    done = "done"
+    failed = "failed"
+
+
 class Receipt(Base):
     __tablename__ = "receipts"
 
@@ -30,6 +40,12 @@ class Receipt(Base):
     token: Mapped[str | None] = mapped_column(String(64), unique=True, nullable=True)
     status: Mapped[ReceiptStatus] = mapped_column(Enum(ReceiptStatus), default=ReceiptStatus.draft, nullable=False)
     image_path: Mapped[str] = mapped_column(String, nullable=False)
+    # Bumped in the same transaction as every change visible in the room; used to validate cached snapshots.
+    revision: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    # Running totals kept in step with item_units by every payment; scripts/rebuild_counters.py repairs them.
+    units_total: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    units_paid: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    amount_paid: Mapped[float] = mapped_column(Numeric(10, 2), default=0, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
 
     items: Mapped[list["ReceiptItem"]] = relationship(
@@ -49,15 +65,20 @@ class ReceiptItem(Base):
     qty_total: Mapped[int] = mapped_column(nullable=False)
     unit_price: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
     amount_total: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
+    units_paid: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    amount_paid: Mapped[float] = mapped_column(Numeric(10, 2), default=0, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
 
-    receipt: Mapped["Receipt"] = relationship(back_populates="items", lazy="joined")
+    receipt: Mapped["Receipt"] = relationship(back_populates="items")
     units: Mapped[list["ItemUnit"]] = relationship(
         back_populates="item", cascade="all, delete-orphan", lazy="selectin", order_by="ItemUnit.unit_index"
     )
     payments: Mapped[list["Payment"]] = relationship(back_populates="item", cascade="all, delete-orphan")
 
-    __table_args__ = (CheckConstraint("qty_total > 0", name="ck_items_qty_positive"),)
+    __table_args__ = (
+        CheckConstraint("qty_total > 0", name="ck_items_qty_positive"),
+        Index("ix_items_receipt_id", "receipt_id"),
+    )
 
 
 class ItemUnit(Base):
@@ -70,12 +91,19 @@ class ItemUnit(Base):
     amount_paid: Mapped[float] = mapped_column(Numeric(10, 2), default=0, nullable=False)
     status: Mapped[UnitStatus] = mapped_column(Enum(UnitStatus), default=UnitStatus.unpaid, nullable=False)
 
-    item: Mapped["ReceiptItem"] = relationship(back_populates="units", lazy="joined")
+    item: Mapped["ReceiptItem"] = relationship(back_populates="units")
     payments: Mapped[list["Payment"]] = relationship(back_populates="unit", cascade="all, delete-orphan")
 
     __table_args__ = (
         UniqueConstraint("item_id", "unit_index", name="uq_item_unit_index"),
         CheckConstraint("amount_paid >= 0", name="ck_unit_amount_paid_non_negative"),
+        # Serves the "next unpaid unit of this item" pick; shrinks as a receipt gets paid.
+        Index(
+            "ix_item_units_unpaid",
+            "item_id",
+            "unit_index",
+            postgresql_where=text("amount_paid < amount_total"),
+        ),
     )
 
 
@@ -90,7 +118,41 @@ class Payment(Base):
     amount: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
 
-    receipt: Mapped["Receipt"] = relationship(back_populates="payments", lazy="joined")
-    item: Mapped["ReceiptItem"] = relationship(back_populates="payments", lazy="joined")
-    unit: Mapped["ItemUnit"] = relationship(back_populates="payments", lazy="joined")
+    receipt: Mapped["Receipt"] = relationship(back_populates="payments")
+    item: Mapped["ReceiptItem"] = relationship(back_populates="payments")
+    unit: Mapped["ItemUnit"] = relationship(back_populates="payments")
+
+    __table_args__ = (
+        Index("ix_payments_receipt_id_created_at", "receipt_id", text("created_at DESC")),
+        Index("ix_payments_item_id", "item_id"),
+        Index("ix_payments_unit_id", "unit_id"),
+    )
+
+
 
+class OcrJob(Base):
+    __tablename__ = "ocr_jobs"
+
+    id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    stage: Mapped[OcrJobStage] = mapped_column(Enum(OcrJobStage), default=OcrJobStage.saved, nullable=False)
+    image_path: Mapped[str] = mapped_column(String, nullable=False)
+    receipt_id: Mapped[uuid.UUID | None] = mapped_column(
+        ForeignKey("receipts.id", ondelete="SET NULL"), nullable=True, index=True
+    )
+    error: Mapped[str | None] = mapped_column(String, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+
+
+class PaymentIdempotencyKey(Base):
+    __tablename__ = "payment_idempotency_keys"
+
+    receipt_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("receipts.id", ondelete="CASCADE"), primary_key=True
+    )
+    key: Mapped[str] = mapped_column(String(128), primary_key=True)
+    request_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    response: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), default=datetime.utcnow, nullable=False, index=True
+    )
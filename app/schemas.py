@@ -4,7 +4,7 @@ from typing import Literal
 
 from pydantic import BaseModel, Field, validator
 
-from app.models import ReceiptStatus, UnitStatus
+from app.models import OcrJobStage, ReceiptStatus, UnitStatus
 
 
 class ItemBase(BaseModel):
@@ -41,8 +41,12 @@ class ItemSchema(ItemBase):
         orm_mode = True
 
 
+class ItemDraft(ItemBase):
+    id: uuid.UUID | None = None
+
+
 class ItemUpdate(BaseModel):
-    items: list[ItemBase]
+    items: list[ItemDraft]
 
 
 class ItemUnitSchema(BaseModel):
@@ -62,6 +66,8 @@ class ItemWithUnits(BaseModel):
     qty_total: int
     unit_price: float
     amount_total: float
+    units_paid: int
+    amount_paid: float
     units: list[ItemUnitSchema]
 
     class Config:
@@ -79,9 +85,47 @@ class PaymentSchema(BaseModel):
         orm_mode = True
 
 
+class UnitDelta(BaseModel):
+    id: uuid.UUID
+    item_id: uuid.UUID
+    amount_paid: float
+    status: UnitStatus
+
+    class Config:
+        orm_mode = True
+
+
+class ItemProgress(BaseModel):
+    id: uuid.UUID
+    units_paid: int
+    amount_paid: float
+
+    class Config:
+        orm_mode = True
+
+
+class PaymentDelta(BaseModel):
+    """WebSocket message with everything a payment changed; ``seq`` is the receipt revision it produced."""
+
+    type: Literal["payment"] = "payment"
+    seq: int
+    payer: str
+    receipt_status: ReceiptStatus
+    units_total: int
+    units_paid: int
+    amount_paid: float
+    items: list[ItemProgress]
+    units: list[UnitDelta]
+    payments: list[PaymentSchema]
+
+
 class ReceiptRoomResponse(BaseModel):
     token: str
     status: ReceiptStatus
+    revision: int
+    units_total: int
+    units_paid: int
+    amount_paid: float
     items: list[ItemWithUnits]
     payments: list[PaymentSchema]
     created_at: datetime
@@ -114,6 +158,11 @@ class PaymentRequest(BaseModel):
     lines: list[PaymentLine]
 
 
+class PaymentResponse(BaseModel):
+    status: str
+    seq: int
+
+
 class FinalizeResponse(BaseModel):
     room_url: str
 
@@ -128,6 +177,59 @@ class OcrPreviewResponse(BaseModel):
     items: list[ParsedOcrItem]
 
 
+class BatchFileResult(BaseModel):
+    type: Literal["file"] = "file"
+    index: int
+    filename: str
+    receipt_id: uuid.UUID | None = None
+    items: list[ParsedOcrItem] = []
+    error: str | None = None
+
+
+class BatchReceiptResult(BaseModel):
+    type: Literal["receipt"] = "receipt"
+    receipt_id: uuid.UUID | None = None
+    items_count: int = 0
+    error: str | None = None
+
+
+class OcrJobResponse(BaseModel):
+    id: uuid.UUID
+    stage: OcrJobStage
+    receipt_id: uuid.UUID | None = None
+    error: str | None = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class OcrCacheStats(BaseModel):
+    enabled: bool
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+class RoomDeliveryStats(BaseModel):
+    connections: int
+    messages: int
+    frames: int
+    messages_per_second: float
+
+
+class WebSocketStats(BaseModel):
+    rooms: int
+    connections: int
+    rejected: int
+    reaped: int
+    messages: int
+    frames: int
+    coalescing_ratio: float
+    busiest_rooms: list[RoomDeliveryStats]
+
+
 class HealthResponse(BaseModel):
     status: str
 
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from datetime import timedelta
+
+from sqlalchemy import delete, func, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import get_settings
+from app.db import background_session
+from app.models import PaymentIdempotencyKey, Receipt
+
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+PURGE_INTERVAL_SECONDS = 3600
+
+_purger: asyncio.Task | None = None
+
+
+def request_fingerprint(payload: dict) -> str:
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+async def claim_key(session: AsyncSession, token: str, key: str, fingerprint: str) -> PaymentIdempotencyKey | None:
+    """
+    Reserve ``key`` for this request inside the caller's transaction.
+
+    Returns ``None`` when the key is new and the caller should do the work, or
+    the stored row when an earlier request already committed it. A request
+    racing with an uncommitted one for the same key waits on the primary key
+    until that transaction ends, so only one of them ever runs the payment.
+    Unknown tokens also return ``None``; the payment itself reports them.
+    """
+    stmt = (
+        insert(PaymentIdempotencyKey)
+        .from_select(
+            ["receipt_id", "key", "request_hash", "created_at"],
+            select(Receipt.id, literal(key), literal(fingerprint), func.now()).where(Receipt.token == token),
+        )
+        .on_conflict_do_nothing()
+        .returning(PaymentIdempotencyKey.key)
+    )
+    if (await session.execute(stmt)).first() is not None:
+        return None
+    result = await session.execute(
+        select(PaymentIdempotencyKey)
+        .join(Receipt, Receipt.id == PaymentIdempotencyKey.receipt_id)
+        .where(Receipt.token == token, PaymentIdempotencyKey.key == key)
+    )
+    return result.scalar_one_or_none()
+
+
+async def store_response(session: AsyncSession, receipt_id: uuid.UUID, key: str, response: dict) -> None:
+    await session.execute(
+        update(PaymentIdempotencyKey)
+        .where(PaymentIdempotencyKey.receipt_id == receipt_id, PaymentIdempotencyKey.key == key)
+        .values(response=response)
+    )
+
+
+async def purge_expired_keys(ttl: timedelta) -> int:
+    async with background_session() as session:
+        result = await session.execute(
+            delete(PaymentIdempotencyKey).where(PaymentIdempotencyKey.created_at < func.now() - ttl)
+        )
+        await session.commit()
+    return result.rowcount
+
+
+async def _purge_forever(ttl: timedelta) -> None:
+    while True:
+        try:
+            purged = await purge_expired_keys(ttl)
+            if purged:
+                logger.info("Purged %s expired payment idempotency keys", purged)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.warning("Failed to purge payment idempotency keys", exc_info=True)
+        await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+
+
+def start_purging() -> None:
+    global _purger
+    if _purger is None:
+        _purger = asyncio.create_task(_purge_forever(timedelta(hours=get_settings().payment_idempotency_ttl_hours)))
+
+
+async def stop_purging() -> None:
+    global _purger
+    if _purger is not None:
+        _purger.cancel()
+        await asyncio.gather(_purger, return_exceptions=True)
+        _purger = None
@@ -1,45 +1,202 @@
 from __future__ import annotations
 
+import hashlib
+import json
+import logging
 import re
+import time
 import uuid
+from collections.abc import Awaitable, Callable
 from pathlib import Path
+from typing import NamedTuple
 
 import cv2
 import numpy as np
-import pytesseract
 from fastapi import UploadFile
 
 from app.core.config import get_settings
+from app.core.metrics import OCR_PREPROCESS_STEP_SECONDS, OCR_STAGE_SECONDS
 from app.schemas import ParsedOcrItem
+from app.services.ocr_backends import TESSERACT_LANG, get_backend
+from app.services.ocr_cache import ocr_cache
+from app.services.ocr_pool import OcrReservation, ocr_pool
 
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
 
+StageCallback = Callable[[str], Awaitable[None]]
 
-def _deskew(image: np.ndarray) -> np.ndarray:
-    coords = np.column_stack(np.where(image > 0))
-    if coords.size == 0:
+# Bump when preprocess_image or parse_items change output for the same image, so cached results are not reused.
+OCR_PIPELINE_VERSION = 3
+
+# Paper detection and skew estimation run on small copies of the frame.
+PAPER_DETECT_WIDTH = 480
+MIN_PAPER_AREA_RATIO = 0.15
+MAX_PAPER_AREA_RATIO = 0.95
+PAPER_MARGIN_RATIO = 0.01
+MAX_UPSCALE = 2.0
+SKEW_ESTIMATE_WIDTH = 400
+MIN_SKEW_DEGREES = 0.25
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+IMAGE_SIGNATURES: tuple[tuple[re.Pattern[bytes], str], ...] = (
+    (re.compile(rb"\xff\xd8\xff"), ".jpg"),
+    (re.compile(rb"\x89PNG\r\n\x1a\n"), ".png"),
+    (re.compile(rb"RIFF.{4}WEBP", re.DOTALL), ".webp"),
+    (re.compile(rb"BM"), ".bmp"),
+    (re.compile(rb"II\*\x00|MM\x00\*"), ".tiff"),
+)
+
+
+class UploadError(Exception):
+    pass
+
+
+class UnsupportedImageType(UploadError):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+class SavedUpload(NamedTuple):
+    path: Path
+    sha256: str
+    size: int
+
+
+def ocr_fingerprint() -> str:
+    return json.dumps(
+        {
+            "pipeline": OCR_PIPELINE_VERSION,
+            "lang": TESSERACT_LANG,
+            "backend": settings.ocr_backend,
+            "tesseract_cmd": settings.tesseract_cmd,
+            "target_width": settings.ocr_target_width,
+            "crop_paper": settings.ocr_crop_paper,
+            "max_skew": settings.ocr_max_skew_degrees,
+        },
+        sort_keys=True,
+    )
+
+
+def format_timings(timings: dict[str, float]) -> str:
+    return " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in timings.items())
+
+
+class StageTimer:
+    def __init__(self) -> None:
+        self.timings: dict[str, float] = {}
+        self._started = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self._started
+        self._started = now
+
+
+def _resize_to_width(image: np.ndarray, width: int) -> tuple[np.ndarray, float]:
+    h, w = image.shape[:2]
+    if w <= width:
+        return image, 1.0
+    scale = width / w
+    return cv2.resize(image, (width, max(1, round(h * scale))), interpolation=cv2.INTER_AREA), scale
+
+
+def _find_paper_region(gray: np.ndarray) -> tuple[int, int, int, int] | None:
+    """Bounding box (x, y, w, h) of the bright receipt paper, or None when no distinct paper is visible."""
+    small, scale = _resize_to_width(gray, PAPER_DETECT_WIDTH)
+    small = cv2.GaussianBlur(small, (5, 5), 0)
+    _, mask = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Close the gaps left by printed text so the paper becomes one blob.
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15)))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    area_ratio = (w * h) / (small.shape[0] * small.shape[1])
+    if not MIN_PAPER_AREA_RATIO <= area_ratio <= MAX_PAPER_AREA_RATIO:
+        return None
+    margin = round(max(small.shape[:2]) * PAPER_MARGIN_RATIO)
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(small.shape[1], x + w + margin), min(small.shape[0], y + h + margin)
+    return (
+        int(x0 / scale),
+        int(y0 / scale),
+        min(gray.shape[1], round((x1 - x0) / scale)),
+        min(gray.shape[0], round((y1 - y0) / scale)),
+    )
+
+
+def _normalize_width(gray: np.ndarray, target_width: int) -> np.ndarray:
+    h, w = gray.shape[:2]
+    if target_width <= 0 or w == target_width:
+        return gray
+    scale = min(target_width / w, MAX_UPSCALE)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(gray, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=interpolation)
+
+
+def _projection_score(ink: np.ndarray, angle: float) -> float:
+    h, w = ink.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    rotated = cv2.warpAffine(ink, matrix, (w, h), flags=cv2.INTER_NEAREST, borderValue=0)
+    profile = rotated.sum(axis=1, dtype=np.float64)
+    # Text lines aligned with the rows give sharp steps between neighbouring row sums.
+    return float(np.square(np.diff(profile)).sum())
+
+
+def _estimate_skew(binary: np.ndarray, max_degrees: float) -> float:
+    ink, _ = _resize_to_width(cv2.bitwise_not(binary), SKEW_ESTIMATE_WIDTH)
+    if not ink.any():
+        return 0.0
+    coarse = np.arange(-max_degrees, max_degrees + 0.5, 1.0)
+    best = max(coarse, key=lambda angle: _projection_score(ink, angle))
+    fine = np.arange(best - 1.0, best + 1.05, 0.1)
+    return float(max(fine, key=lambda angle: _projection_score(ink, angle)))
+
+
+def _deskew(image: np.ndarray, max_degrees: float | None = None) -> np.ndarray:
+    if max_degrees is None:
+        max_degrees = settings.ocr_max_skew_degrees
+    if max_degrees <= 0:
+        return image
+    angle = _estimate_skew(image, max_degrees)
+    if abs(angle) < MIN_SKEW_DEGREES:
         return image
-    angle = cv2.minAreaRect(coords)[-1]
-    if angle < -45:
-        angle = -(90 + angle)
-    else:
-        angle = -angle
     (h, w) = image.shape[:2]
     center = (w // 2, h // 2)
     matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
     return cv2.warpAffine(image, matrix, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
 
 
-def preprocess_image(path: Path) -> np.ndarray:
-    image = cv2.imread(str(path))
-    if image is None:
+def preprocess_image_timed(path: Path) -> tuple[np.ndarray, dict[str, float]]:
+    timer = StageTimer()
+    gray = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
         raise ValueError(f"OpenCV failed to read image at {path}")
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    timer.lap("decode")
+    if settings.ocr_crop_paper:
+        region = _find_paper_region(gray)
+        if region is not None:
+            x, y, w, h = region
+            gray = gray[y : y + h, x : x + w]
+        timer.lap("crop")
+    gray = _normalize_width(gray, settings.ocr_target_width)
+    timer.lap("resize")
     gray = cv2.GaussianBlur(gray, (3, 3), 0)
     _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    timer.lap("binarize")
     deskewed = _deskew(thresh)
-    return deskewed
+    timer.lap("deskew")
+    return deskewed, timer.timings
+
+
+def preprocess_image(path: Path) -> np.ndarray:
+    return preprocess_image_timed(path)[0]
 
 
 SERVICE_KEYWORDS = {"итог", "наличные", "безналичные", "инн", "фн", "фп", "кассир", "дата", "qr"}
@@ -56,7 +213,8 @@ def _normalize_numeric_chars(text: str) -> str:
 
 
 def _strip_position_prefix(text: str) -> str:
-    return re.sub(r"^\s*\d+\.\s*", "", text)
+    # "12. Name" is a position number, "785.00 x 3" is a price.
+    return re.sub(r"^\s*\d+\.(?!\d)\s*", "", text)
 
 
 def _extract_numbers(line: str) -> list[str]:
@@ -125,20 +283,93 @@ def parse_items(text: str) -> list[ParsedOcrItem]:
     return items
 
 
-async def save_upload(file: UploadFile, media_dir: Path) -> Path:
+def sniff_image_suffix(head: bytes) -> str | None:
+    for signature, suffix in IMAGE_SIGNATURES:
+        if signature.match(head):
+            return suffix
+    return None
+
+
+async def save_upload(file: UploadFile, media_dir: Path, max_bytes: int | None = None) -> SavedUpload:
+    """Stream the upload to ``media_dir`` chunk by chunk, hashing it and enforcing ``max_bytes`` on the way."""
+    if max_bytes is None:
+        max_bytes = settings.upload_max_mb * 1024 * 1024
+    first_chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    suffix = sniff_image_suffix(first_chunk)
+    if suffix is None:
+        raise UnsupportedImageType("Uploaded file is not a supported image")
     media_dir.mkdir(parents=True, exist_ok=True)
-    suffix = Path(file.filename or "").suffix or ".png"
-    filename = f"{uuid.uuid4()}{suffix}"
-    destination = media_dir / filename
-    content = await file.read()
-    destination.write_bytes(content)
-    return destination
+    destination = media_dir / f"{uuid.uuid4()}{suffix}"
+    digest = hashlib.sha256()
+    size = 0
+    started = time.perf_counter()
+    try:
+        with destination.open("wb") as out:
+            chunk = first_chunk
+            while chunk:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+                digest.update(chunk)
+                out.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    except BaseException:
+        destination.unlink(missing_ok=True)
+        raise
+    OCR_STAGE_SECONDS.labels("save").observe(time.perf_counter() - started)
+    return SavedUpload(destination, digest.hexdigest(), size)
 
 
-async def extract_items(file: UploadFile, media_root: Path) -> tuple[Path, str, list[ParsedOcrItem]]:
-    saved_path = await save_upload(file, media_root)
-    processed = preprocess_image(saved_path)
-    pytesseract.pytesseract.tesseract_cmd = settings.tesseract_cmd or pytesseract.pytesseract.tesseract_cmd
-    text = pytesseract.image_to_string(processed, lang="rus+eng")
+def recognize_text(image: np.ndarray) -> str:
+    return get_backend().recognize(image)
+
+
+async def recognize_image(
+    upload: SavedUpload, on_stage: StageCallback | None = None, reservation: OcrReservation | None = None
+) -> tuple[str, list[ParsedOcrItem]]:
+    async def report(stage: str) -> None:
+        if on_stage is not None:
+            await on_stage(stage)
+
+    cache_key = ocr_cache.make_key(upload.sha256, ocr_fingerprint())
+    cached = ocr_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    await report("preprocessing")
+    timer = StageTimer()
+    async with ocr_pool.slot(reservation):
+        processed, preprocess_timings = await ocr_pool.run(preprocess_image_timed, upload.path)
+        timer.lap("preprocess")
+        await report("recognizing")
+        text = await ocr_pool.run(recognize_text, processed)
+        timer.lap("tesseract")
+    await report("parsing")
     items = parse_items(text)
-    return saved_path, text, items
+    timer.lap("parse")
+    for stage, seconds in timer.timings.items():
+        OCR_STAGE_SECONDS.labels(stage).observe(seconds)
+    for step, seconds in preprocess_timings.items():
+        OCR_PREPROCESS_STEP_SECONDS.labels(step).observe(seconds)
+    logger.info(
+        "OCR of %s (%d bytes, %dx%d processed): %s; preprocess stages: %s",
+        upload.path.name,
+        upload.size,
+        processed.shape[1],
+        processed.shape[0],
+        format_timings(timer.timings),
+        format_timings(preprocess_timings),
+    )
+    ocr_cache.put(cache_key, text, items)
+    return text, items
+
+
+async def extract_items(file: UploadFile, media_root: Path) -> tuple[Path, str, list[ParsedOcrItem]]:
+    # The cache key is the image hash, so the upload is saved first; only a cache miss needs a pool slot.
+    upload = await save_upload(file, media_root)
+    try:
+        text, items = await recognize_image(upload)
+    except BaseException:
+        upload.path.unlink(missing_ok=True)
+        raise
+    return upload.path, text, items
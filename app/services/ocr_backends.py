@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from functools import lru_cache
+from typing import Protocol
+
+import numpy as np
+import pytesseract
+
+from app.core.config import get_settings
+
+
+logger = logging.getLogger(__name__)
+
+TESSERACT_LANG = "rus+eng"
+
+
+class OcrEngineError(Exception):
+    """The engine is installed but failed to recognise the image (e.g. missing language data)."""
+
+
+class OcrEngineNotFound(OcrEngineError):
+    """The engine itself is not available in this environment."""
+
+
+class OcrBackend(Protocol):
+    name: str
+
+    def recognize(self, image: np.ndarray) -> str: ...
+
+    def warm_up(self) -> None: ...
+
+
+class PytesseractBackend:
+    """Runs the ``tesseract`` binary once per image; slow to start but has no native dependencies."""
+
+    name = "pytesseract"
+
+    def __init__(self, lang: str, tesseract_cmd: str | None = None) -> None:
+        self.lang = lang
+        if tesseract_cmd:
+            pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+
+    def recognize(self, image: np.ndarray) -> str:
+        # pytesseract's own exceptions do not survive pickling across a process pool, so they are translated here.
+        try:
+            return pytesseract.image_to_string(image, lang=self.lang)
+        except pytesseract.TesseractNotFoundError as exc:
+            raise OcrEngineNotFound(str(exc)) from None
+        except pytesseract.TesseractError as exc:
+            raise OcrEngineError(str(exc)) from None
+
+    def warm_up(self) -> None:
+        pass
+
+
+class TesserocrBackend:
+    """Keeps up to ``pool_size`` initialised libtesseract engines per process and reuses them between images."""
+
+    name = "tesserocr"
+
+    def __init__(self, lang: str, pool_size: int) -> None:
+        import tesserocr
+
+        self._tesserocr = tesserocr
+        self.lang = lang
+        self.pool_size = max(1, pool_size)
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _create_engine(self):
+        try:
+            return self._tesserocr.PyTessBaseAPI(lang=self.lang)
+        except RuntimeError as exc:
+            raise OcrEngineError(str(exc)) from None
+
+    def _reserve_slot(self) -> bool:
+        with self._lock:
+            if self._created >= self.pool_size:
+                return False
+            self._created += 1
+            return True
+
+    def _create_reserved_engine(self):
+        try:
+            return self._create_engine()
+        except BaseException:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        if self._reserve_slot():
+            return self._create_reserved_engine()
+        return self._idle.get()
+
+    def recognize(self, image: np.ndarray) -> str:
+        engine = self._acquire()
+        try:
+            image = np.ascontiguousarray(image, dtype=np.uint8)
+            height, width = image.shape[:2]
+            channels = 1 if image.ndim == 2 else image.shape[2]
+            engine.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+            return engine.GetUTF8Text()
+        except RuntimeError as exc:
+            raise OcrEngineError(str(exc)) from None
+        finally:
+            engine.Clear()
+            self._idle.put(engine)
+
+    def warm_up(self) -> None:
+        if self._reserve_slot():
+            self._idle.put(self._create_reserved_engine())
+
+
+@lru_cache
+def get_backend() -> OcrBackend:
+    """Backend for the current process; process-pool workers build their own on first use."""
+    settings = get_settings()
+    if settings.ocr_backend == "tesserocr":
+        try:
+            return TesserocrBackend(TESSERACT_LANG, settings.ocr_engine_pool_size or settings.ocr_workers)
+        except ImportError:
+            logger.warning("tesserocr is not installed, falling back to pytesseract")
+    return PytesseractBackend(TESSERACT_LANG, settings.tesseract_cmd)
+
+
+def warm_up_backend() -> None:
+    try:
+        get_backend().warm_up()
+    except Exception:
+        logger.warning("Failed to warm up the OCR engine", exc_info=True)
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+
+from app.core.config import Settings, get_settings
+from app.core.metrics import OCR_CACHE_LOOKUPS
+from app.schemas import ParsedOcrItem
+
+
+logger = logging.getLogger(__name__)
+
+EVICTION_INTERVAL_SECONDS = 300
+
+
+class OcrCache:
+    """
+    Content-addressed store of OCR results on disk.
+
+    Entries live under ``directory`` (on the shared media volume by default), so
+    every gunicorn worker sees results produced by the others. The file mtime
+    doubles as the last-use time: hits touch it, and eviction drops entries older
+    than ``ttl_seconds`` first and then the least recently used ones until the
+    cache fits into ``max_bytes``.
+
+    ``hits`` and ``misses`` count this worker's lookups only; the
+    ``ocr_cache_lookups`` counter on ``/metrics`` sums them over all workers.
+    """
+
+    def __init__(self, directory: Path, ttl_seconds: int, max_bytes: int, enabled: bool = True) -> None:
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._last_eviction = 0.0
+        self._eviction: asyncio.Task | None = None
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "OcrCache":
+        directory = Path(settings.ocr_cache_dir) if settings.ocr_cache_dir else Path(settings.media_root) / "ocr-cache"
+        return cls(
+            directory=directory,
+            ttl_seconds=settings.ocr_cache_ttl_seconds,
+            max_bytes=settings.ocr_cache_max_mb * 1024 * 1024,
+            enabled=settings.ocr_cache_enabled,
+        )
+
+    @staticmethod
+    def make_key(image_sha256: str, fingerprint: str) -> str:
+        return hashlib.sha256(f"{image_sha256}:{fingerprint}".encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> tuple[str, list[ParsedOcrItem]] | None:
+        if not self.enabled:
+            return None
+        path = self._entry_path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                raise FileNotFoundError(path)
+            payload = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            OCR_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+        self.hits += 1
+        OCR_CACHE_LOOKUPS.labels("hit").inc()
+        return payload["text"], [ParsedOcrItem(**item) for item in payload["items"]]
+
+    def put(self, key: str, text: str, items: list[ParsedOcrItem]) -> None:
+        if not self.enabled:
+            return
+        path = self._entry_path(key)
+        payload = json.dumps({"text": text, "items": [item.dict() for item in items]}, ensure_ascii=False)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_text(payload, encoding="utf-8")
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.warning("Failed to store OCR cache entry %s", key, exc_info=True)
+            return
+        self._schedule_eviction()
+
+    def _schedule_eviction(self) -> None:
+        now = time.monotonic()
+        if now - self._last_eviction < EVICTION_INTERVAL_SECONDS:
+            return
+        if self._eviction is not None and not self._eviction.done():
+            return
+        self._last_eviction = now
+        self._eviction = asyncio.get_running_loop().create_task(asyncio.to_thread(self.evict))
+
+    def evict(self) -> int:
+        entries: list[tuple[float, int, Path]] = []
+        now = time.time()
+        removed = 0
+        for path in self.directory.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                removed += 1
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info("Evicted %d OCR cache entries", removed)
+        return removed
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+ocr_cache = OcrCache.from_settings(get_settings())
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import uuid
+from collections.abc import Coroutine
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import update
+
+from app.core.websocket_manager import manager
+from app.db import background_session
+from app.models import OcrJob, OcrJobStage
+
+
+# Strong references to running jobs; asyncio only keeps weak ones.
+_running_jobs: set[asyncio.Task] = set()
+
+
+def job_channel(job_id: uuid.UUID) -> str:
+    return f"job:{job_id}"
+
+
+def job_message(job: OcrJob) -> dict:
+    return {
+        "type": "job",
+        "id": str(job.id),
+        "stage": job.stage.value,
+        "receipt_id": str(job.receipt_id) if job.receipt_id else None,
+        "error": job.error,
+    }
+
+
+async def publish_job(job: OcrJob) -> None:
+    await manager.broadcast(job_channel(job.id), job_message(job))
+
+
+async def update_job(job_id: uuid.UUID, stage: OcrJobStage, **values: Any) -> OcrJob | None:
+    async with background_session() as session:
+        result = await session.execute(
+            update(OcrJob)
+            .where(OcrJob.id == job_id)
+            .values(stage=stage, updated_at=datetime.utcnow(), **values)
+            .returning(OcrJob)
+        )
+        job = result.scalar_one_or_none()
+        await session.commit()
+    if job is not None:
+        await publish_job(job)
+    return job
+
+
+def spawn_job(coro: Coroutine[Any, Any, None]) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _running_jobs.add(task)
+    task.add_done_callback(_running_jobs.discard)
+    return task
+
+
+async def cancel_running_jobs() -> None:
+    for task in list(_running_jobs):
+        task.cancel()
+    await asyncio.gather(*_running_jobs, return_exceptions=True)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+from collections.abc import AsyncIterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, TypeVar
+
+from app.core.config import Settings, get_settings
+from app.services.ocr_backends import warm_up_backend
+
+
+T = TypeVar("T")
+
+
+class OcrPoolError(Exception):
+    pass
+
+
+class OcrQueueFull(OcrPoolError):
+    pass
+
+
+class OcrTimeout(OcrPoolError):
+    pass
+
+
+class _Slot:
+    def __init__(self) -> None:
+        # The last stage submitted under this slot; a timed-out one may still be running.
+        self.future: Future | None = None
+
+
+_current_slot: ContextVar[_Slot | None] = ContextVar("ocr_slot", default=None)
+
+
+class OcrReservation:
+    """
+    Slots taken at admission for jobs that run later, e.g. after a 202 response.
+
+    Each ``slot(reservation)`` uses one of them; ``close()`` returns the ones
+    no job used (cache hits, failures before OCR) and must always be called.
+    """
+
+    def __init__(self, pool: "OcrPool", jobs: int) -> None:
+        self._pool = pool
+        self.remaining = jobs
+
+    def take(self) -> None:
+        if self.remaining <= 0:
+            raise OcrPoolError("OCR reservation is used up")
+        self.remaining -= 1
+
+    def close(self) -> None:
+        self._pool.pending -= self.remaining
+        self.remaining = 0
+
+
+class OcrPool:
+    """
+    Runs blocking OCR work (OpenCV, Tesseract) off the event loop.
+
+    At most ``workers + queue_size`` jobs are accepted at once; further jobs are
+    rejected with ``OcrQueueFull`` instead of waiting. A job holds one slot for
+    all of its stages (``slot()``), so once admitted it is never rejected
+    halfway through, and ``reserve()`` takes slots at admission for jobs that
+    start later. A stage that exceeds ``timeout`` raises ``OcrTimeout`` but the
+    slot stays taken until the worker actually finishes it, so timed-out work
+    cannot pile up behind the limit.
+    """
+
+    def __init__(self, executor: str, workers: int, queue_size: int, timeout: float) -> None:
+        self.executor_kind = executor
+        self.workers = max(1, workers)
+        self.capacity = self.workers + max(0, queue_size)
+        self.timeout = timeout
+        self.pending = 0
+        self._executor: Executor | None = None
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "OcrPool":
+        return cls(
+            executor=settings.ocr_executor,
+            workers=settings.ocr_workers,
+            queue_size=settings.ocr_queue_size,
+            timeout=settings.ocr_timeout_seconds,
+        )
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == "process":
+                # spawn: forking a process that already runs an event loop and threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=warm_up_backend,
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="ocr", initializer=warm_up_backend
+                )
+        return self._executor
+
+    def check_capacity(self, jobs: int = 1) -> None:
+        if self.pending + jobs > self.capacity:
+            raise OcrQueueFull(f"OCR queue is full ({self.pending}/{self.capacity} jobs, {jobs} requested)")
+
+    def reserve(self, jobs: int = 1) -> OcrReservation:
+        self.check_capacity(jobs)
+        self.pending += jobs
+        return OcrReservation(self, jobs)
+
+    @asynccontextmanager
+    async def slot(self, reservation: OcrReservation | None = None) -> AsyncIterator[None]:
+        """Capacity for one job, from ``reservation`` or taken now; every ``run()`` inside the block uses it."""
+        if reservation is None:
+            reservation = self.reserve()
+        reservation.take()
+        slot = _Slot()
+        token = _current_slot.set(slot)
+        try:
+            yield
+        finally:
+            _current_slot.reset(token)
+            future = slot.future
+            if future is not None and not future.done():
+                loop = asyncio.get_running_loop()
+                future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+            else:
+                self._release()
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        slot = _current_slot.get()
+        if slot is None:
+            async with self.slot():
+                return await self.run(func, *args)
+        future: Future[T] = self._get_executor().submit(func, *args)
+        slot.future = future
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except asyncio.TimeoutError as exc:
+            future.cancel()
+            raise OcrTimeout(f"OCR job did not finish within {self.timeout:g}s") from exc
+
+    def _release(self) -> None:
+        self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+ocr_pool = OcrPool.from_settings(get_settings())
@@ -1,18 +1,42 @@
+import time
 import uuid
+from collections import Counter
+from dataclasses import dataclass, field
 from decimal import Decimal
 
-from sqlalchemy import select
+from sqlalchemy import Integer, Numeric, Select, column, event, insert, or_, select, true, update, values
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, load_only, raiseload
+from sqlalchemy.orm.attributes import set_committed_value
 
-from app.models import ItemUnit, Payment, Receipt, ReceiptStatus, UnitStatus
+from app.core.metrics import RECEIPT_LOCK_HOLD_SECONDS, RECEIPT_LOCK_WAIT_SECONDS
+
+from app.models import ItemUnit, Payment, Receipt, ReceiptItem, ReceiptStatus, UnitStatus
+
+
+# session.info key: when this transaction got the receipt row lock.
+RECEIPT_LOCKED_AT = "receipt_locked_at"
 
 
 class PaymentError(Exception):
     pass
 
 
-async def _lock_receipt(session: AsyncSession, token: str) -> Receipt:
-    result = await session.execute(select(Receipt).where(Receipt.token == token).with_for_update())
+@dataclass
+class PaymentResult:
+    receipt: Receipt
+    payments: list[Payment] = field(default_factory=list)
+    units: dict[uuid.UUID, ItemUnit] = field(default_factory=dict)
+    # Fresh (id, units_paid, amount_paid) rows for every item the payment touched.
+    items: list = field(default_factory=list)
+
+
+async def _load_open_receipt(session: AsyncSession, token: str) -> Receipt:
+    # No row lock: payers of different units must not wait for each other here. Only the columns checked
+    # here: the selectin relationships would otherwise read every item, unit and payment of the room.
+    stmt = select(Receipt).where(Receipt.token == token).options(load_only(Receipt.id, Receipt.status), raiseload("*"))
+    result = await session.execute(stmt)
     receipt = result.scalar_one_or_none()
     if not receipt:
         raise PaymentError("Receipt not found")
@@ -21,88 +45,196 @@ async def _lock_receipt(session: AsyncSession, token: str) -> Receipt:
     return receipt
 
 
-async def pay_full_unit(session: AsyncSession, item_id: uuid.UUID, receipt_id: uuid.UUID) -> tuple[ItemUnit, float]:
-    unit_stmt = (
-        select(ItemUnit)
-        .join(ItemUnit.item)
-        .where(
-            ItemUnit.item_id == item_id,
-            ItemUnit.amount_paid < ItemUnit.amount_total,
-            ItemUnit.item.has(receipt_id=receipt_id),
+def lock_units_statement(receipt_id: uuid.UUID, full_counts: Counter, partial_unit_ids: set[uuid.UUID]) -> Select | None:
+    """
+    The statement that locks every unit the request touches, or None if it touches none.
+
+    For ``unit_full`` lines a LATERAL subquery takes, per item, as many unpaid
+    units as there are lines for it, lowest ``unit_index`` first; partial lines
+    name their units directly. Full-unit picks skip rows other payers hold, and
+    the outer lock is taken in item/index order so that payers waiting on the
+    same partial units cannot deadlock.
+    """
+    conditions = []
+    if full_counts:
+        requested = values(
+            column("item_id", UUID(as_uuid=True)), column("wanted", Integer), name="requested"
+        ).data(list(full_counts.items()))
+        picked = (
+            select(ItemUnit.id)
+            .where(ItemUnit.item_id == requested.c.item_id, ItemUnit.amount_paid < ItemUnit.amount_total)
+            .order_by(ItemUnit.unit_index)
+            .limit(requested.c.wanted)
+            .with_for_update(skip_locked=True)
+            .lateral("picked")
         )
-        .with_for_update(skip_locked=True)
-        .order_by(ItemUnit.unit_index)
+        conditions.append(ItemUnit.id.in_(select(picked.c.id).select_from(requested).join(picked, true())))
+    if partial_unit_ids:
+        conditions.append(ItemUnit.id.in_(partial_unit_ids))
+    if not conditions:
+        return None
+    return (
+        select(ItemUnit)
+        .join(ReceiptItem, ReceiptItem.id == ItemUnit.item_id)
+        .where(ReceiptItem.receipt_id == receipt_id, or_(*conditions))
+        .order_by(ItemUnit.item_id, ItemUnit.unit_index)
+        .with_for_update(of=ItemUnit)
+        # Units already in the identity map would keep the amounts read before the lock; overwrite them.
+        .execution_options(populate_existing=True)
     )
-    result = await session.execute(unit_stmt)
-    unit = result.scalars().first()
-    if not unit:
-        raise PaymentError("No unpaid units available")
-    remaining = Decimal(unit.amount_total) - Decimal(unit.amount_paid)
-    unit.amount_paid = Decimal(unit.amount_paid) + remaining
-    unit.status = UnitStatus.paid
-    return unit, float(remaining)
-
-
-async def pay_partial_unit(session: AsyncSession, unit_id: uuid.UUID, amount: float, receipt_id: uuid.UUID) -> tuple[ItemUnit, float]:
-    unit_stmt = select(ItemUnit).where(ItemUnit.id == unit_id, ItemUnit.item.has(receipt_id=receipt_id)).with_for_update()
-    result = await session.execute(unit_stmt)
-    unit = result.scalar_one_or_none()
-    if not unit:
-        raise PaymentError("Unit not found")
-    remaining = Decimal(unit.amount_total) - Decimal(unit.amount_paid)
-    amount_decimal = Decimal(str(amount))
-    if amount_decimal <= 0:
-        raise PaymentError("Amount must be positive")
-    if amount_decimal > remaining:
-        raise PaymentError("Payment exceeds remaining balance")
-    unit.amount_paid = Decimal(unit.amount_paid) + amount_decimal
-    if unit.amount_paid == unit.amount_total:
-        unit.status = UnitStatus.paid
-    else:
-        unit.status = UnitStatus.partial
-    return unit, float(amount_decimal)
-
-
-async def finalize_receipt_if_paid(session: AsyncSession, receipt: Receipt) -> None:
-    await session.refresh(receipt, attribute_names=["items"])
-    for item in receipt.items:
-        await session.refresh(item, attribute_names=["units"])
-    all_paid = all(unit.status == UnitStatus.paid for item in receipt.items for unit in item.units)
-    if all_paid and receipt.items:
-        receipt.status = ReceiptStatus.paid
 
 
-async def record_payment(
-    session: AsyncSession, receipt: Receipt, unit: ItemUnit, amount: float, payer_name: str
-) -> Payment:
-    payment = Payment(
-        receipt_id=receipt.id,
-        item_id=unit.item_id,
-        unit_id=unit.id,
-        payer_name=payer_name,
-        amount=Decimal(str(amount)),
+async def _lock_units(
+    session: AsyncSession, receipt_id: uuid.UUID, full_counts: Counter, partial_unit_ids: set[uuid.UUID]
+) -> list[ItemUnit]:
+    stmt = lock_units_statement(receipt_id, full_counts, partial_unit_ids)
+    if stmt is None:
+        return []
+    result = await session.execute(stmt)
+    return list(result.scalars())
+
+
+def _pay_unit(unit: ItemUnit, amount: Decimal) -> bool:
+    """Add ``amount`` to the unit; returns True if this payment completed it."""
+    unit.amount_paid = Decimal(unit.amount_paid) + amount
+    unit.status = UnitStatus.paid if unit.amount_paid == unit.amount_total else UnitStatus.partial
+    return unit.status == UnitStatus.paid
+
+
+async def _add_item_totals(session: AsyncSession, totals: dict[uuid.UUID, list]) -> list:
+    ids = sorted(totals)
+    # The UPDATE below may visit rows in any order; locking them by id first keeps payers from deadlocking.
+    await session.execute(
+        select(ReceiptItem.id).where(ReceiptItem.id.in_(ids)).order_by(ReceiptItem.id).with_for_update(key_share=True)
+    )
+    delta = values(
+        column("id", UUID(as_uuid=True)), column("units", Integer), column("amount", Numeric(10, 2)), name="delta"
+    ).data([(item_id, totals[item_id][0], totals[item_id][1]) for item_id in ids])
+    stmt = (
+        update(ReceiptItem)
+        .where(ReceiptItem.id == delta.c.id)
+        .values(units_paid=ReceiptItem.units_paid + delta.c.units, amount_paid=ReceiptItem.amount_paid + delta.c.amount)
+        .returning(ReceiptItem.id, ReceiptItem.units_paid, ReceiptItem.amount_paid)
+        .execution_options(synchronize_session=False)
+    )
+    return list(await session.execute(stmt))
+
+
+async def _bump_revision(session: AsyncSession, receipt: Receipt, units_paid: int, amount_paid: Decimal) -> None:
+    """
+    Take the receipt row lock for the rest of the transaction.
+
+    This is the only point where payers of one receipt queue up, and it comes
+    last, so the lock is held just for this update and the commit. Increments
+    applied under the lock see every payment committed by earlier holders, so
+    the returned counters tell exactly whether this payment settled the bill.
+    """
+    stmt = (
+        update(Receipt)
+        .where(Receipt.id == receipt.id)
+        .values(
+            revision=Receipt.revision + 1,
+            units_paid=Receipt.units_paid + units_paid,
+            amount_paid=Receipt.amount_paid + amount_paid,
+        )
+        .returning(Receipt.revision, Receipt.units_paid, Receipt.units_total, Receipt.amount_paid)
+        .execution_options(synchronize_session=False)
     )
-    session.add(payment)
-    return payment
+    started = time.perf_counter()
+    row = (await session.execute(stmt)).one()
+    locked_at = time.perf_counter()
+    RECEIPT_LOCK_WAIT_SECONDS.observe(locked_at - started)
+    session.info[RECEIPT_LOCKED_AT] = locked_at
+    for name in ("revision", "units_paid", "units_total", "amount_paid"):
+        set_committed_value(receipt, name, getattr(row, name))
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _observe_receipt_lock_hold(session: Session) -> None:
+    locked_at = session.info.pop(RECEIPT_LOCKED_AT, None)
+    if locked_at is not None:
+        RECEIPT_LOCK_HOLD_SECONDS.observe(time.perf_counter() - locked_at)
 
 
 async def process_payment_lines(
     session: AsyncSession, token: str, payer_name: str, lines: list[dict]
-) -> list[Payment]:
-    receipt = await _lock_receipt(session, token)
-    payments: list[Payment] = []
+) -> PaymentResult:
+    """
+    Apply all payment lines with a fixed number of statements.
+
+    Units are locked and fetched in one query, amounts are checked in memory in
+    line order, then the unit updates and the payment rows go out as two batched
+    statements. Item and receipt counters are incremented with one statement
+    each, and the receipt counters decide whether it is paid.
+
+    Concurrency rests on the unit row locks. Item rows are locked in id order
+    for the counter update, and the receipt row only by ``_bump_revision`` at
+    the very end, which makes the transition to ``paid`` happen exactly once.
+    """
     for line in lines:
-        mode = line["mode"]
-        item_id = line["item_id"]
-        if mode == "unit_full":
-            unit, amount = await pay_full_unit(session, item_id=item_id, receipt_id=receipt.id)
-            payment = await record_payment(session, receipt, unit, amount, payer_name)
+        if line["mode"] != "unit_full" and Decimal(str(line["amount"])) <= 0:
+            raise PaymentError("Amount must be positive")
+    receipt = await _load_open_receipt(session, token)
+    full_counts = Counter(line["item_id"] for line in lines if line["mode"] == "unit_full")
+    partial_unit_ids = {line["unit_id"] for line in lines if line["mode"] != "unit_full"}
+    locked = await _lock_units(session, receipt.id, full_counts, partial_unit_ids)
+    units_by_id = {unit.id: unit for unit in locked}
+    units_by_item: dict[uuid.UUID, list[ItemUnit]] = {}
+    for unit in locked:
+        units_by_item.setdefault(unit.item_id, []).append(unit)
+
+    result = PaymentResult(receipt=receipt)
+    rows = []
+    item_totals: dict[uuid.UUID, list] = {}
+    for line in lines:
+        if line["mode"] == "unit_full":
+            unit = next(
+                (
+                    candidate
+                    for candidate in units_by_item.get(line["item_id"], [])
+                    if Decimal(candidate.amount_paid) < Decimal(candidate.amount_total)
+                ),
+                None,
+            )
+            if unit is None:
+                raise PaymentError("No unpaid units available")
+            amount = Decimal(unit.amount_total) - Decimal(unit.amount_paid)
         else:
-            unit_id = line["unit_id"]
-            amount = line["amount"]
-            unit, amount = await pay_partial_unit(session, unit_id=unit_id, amount=amount, receipt_id=receipt.id)
-            payment = await record_payment(session, receipt, unit, amount, payer_name)
-        payments.append(payment)
+            unit = units_by_id.get(line["unit_id"])
+            if unit is None:
+                raise PaymentError("Unit not found")
+            amount = Decimal(str(line["amount"]))
+            if amount > Decimal(unit.amount_total) - Decimal(unit.amount_paid):
+                raise PaymentError("Payment exceeds remaining balance")
+        completed = _pay_unit(unit, amount)
+        totals = item_totals.setdefault(unit.item_id, [0, Decimal("0")])
+        totals[0] += int(completed)
+        totals[1] += amount
+        result.units[unit.id] = unit
+        rows.append(
+            {
+                "id": uuid.uuid4(),
+                "receipt_id": receipt.id,
+                "item_id": unit.item_id,
+                "unit_id": unit.id,
+                "payer_name": payer_name,
+                "amount": amount,
+            }
+        )
+
     await session.flush()
-    await finalize_receipt_if_paid(session, receipt)
-    return payments
+    if rows:
+        inserted = await session.scalars(insert(Payment).returning(Payment), rows)
+        result.payments = list(inserted)
+    if item_totals:
+        result.items = await _add_item_totals(session, item_totals)
+    await _bump_revision(
+        session,
+        receipt,
+        units_paid=sum(totals[0] for totals in item_totals.values()),
+        amount_paid=sum((totals[1] for totals in item_totals.values()), Decimal("0")),
+    )
+    if receipt.units_total and receipt.units_paid >= receipt.units_total:
+        receipt.status = ReceiptStatus.paid
+    return result
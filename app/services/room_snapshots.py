@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import asyncio
+import uuid
+import weakref
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import Any, NamedTuple
+
+from sqlalchemy import Select, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import get_settings
+from app.core.fastjson import dumps
+from app.models import ItemUnit, Payment, Receipt, ReceiptItem
+
+
+class RoomSnapshot(NamedTuple):
+    revision: int
+    body: bytes
+
+
+def room_body(receipt: Any, items: Sequence[Any], units: Sequence[Any], payments: Sequence[Any]) -> dict:
+    """The ``ReceiptRoomResponse`` document from query rows; units must be ordered by ``unit_index``."""
+    units_by_item: dict[uuid.UUID, list[dict]] = {item.id: [] for item in items}
+    for unit in units:
+        units_by_item[unit.item_id].append(
+            {
+                "id": unit.id,
+                "unit_index": unit.unit_index,
+                "amount_total": unit.amount_total,
+                "amount_paid": unit.amount_paid,
+                "status": unit.status,
+            }
+        )
+    return {
+        "token": receipt.token,
+        "status": receipt.status,
+        "revision": receipt.revision,
+        "units_total": receipt.units_total,
+        "units_paid": receipt.units_paid,
+        "amount_paid": receipt.amount_paid,
+        "items": [
+            {
+                "id": item.id,
+                "name": item.name,
+                "qty_total": item.qty_total,
+                "unit_price": item.unit_price,
+                "amount_total": item.amount_total,
+                "units_paid": item.units_paid,
+                "amount_paid": item.amount_paid,
+                "units": units_by_item[item.id],
+            }
+            for item in items
+        ],
+        "payments": [
+            {
+                "id": payment.id,
+                "payer_name": payment.payer_name,
+                "amount": payment.amount,
+                "unit_id": payment.unit_id,
+                "created_at": payment.created_at,
+            }
+            for payment in payments
+        ],
+        "created_at": receipt.created_at,
+    }
+
+
+async def load_room(session: AsyncSession, receipt_id: uuid.UUID) -> RoomSnapshot:
+    """
+    Read the room as plain rows and encode it once; no ORM objects or pydantic models on this path.
+
+    The four reads share one REPEATABLE READ snapshot. Under READ COMMITTED a
+    payment committing between them could land in the rows but not in the
+    revision, and a client would then apply its delta on top of a body that
+    already contains it.
+    """
+    # The caller's transaction has only read the revision; end it so the next one can pick its isolation level.
+    await session.commit()
+    await session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    try:
+        return await _read_room(session, receipt_id)
+    finally:
+        # Read-only; rolling back just releases the snapshot.
+        await session.rollback()
+
+
+class RoomQueries(NamedTuple):
+    receipt: Select
+    items: Select
+    units: Select
+    payments: Select
+
+
+def room_queries(receipt_id: uuid.UUID) -> RoomQueries:
+    """The statements ``load_room`` sends; ``benchmarks/query_plans.py`` checks their plans."""
+    return RoomQueries(
+        receipt=select(
+            Receipt.token,
+            Receipt.status,
+            Receipt.revision,
+            Receipt.units_total,
+            Receipt.units_paid,
+            Receipt.amount_paid,
+            Receipt.created_at,
+        ).where(Receipt.id == receipt_id),
+        items=select(
+            ReceiptItem.id,
+            ReceiptItem.name,
+            ReceiptItem.qty_total,
+            ReceiptItem.unit_price,
+            ReceiptItem.amount_total,
+            ReceiptItem.units_paid,
+            ReceiptItem.amount_paid,
+        )
+        .where(ReceiptItem.receipt_id == receipt_id)
+        .order_by(ReceiptItem.created_at, ReceiptItem.id),
+        units=select(
+            ItemUnit.id,
+            ItemUnit.item_id,
+            ItemUnit.unit_index,
+            ItemUnit.amount_total,
+            ItemUnit.amount_paid,
+            ItemUnit.status,
+        )
+        .join(ReceiptItem, ReceiptItem.id == ItemUnit.item_id)
+        .where(ReceiptItem.receipt_id == receipt_id)
+        .order_by(ItemUnit.item_id, ItemUnit.unit_index),
+        payments=select(Payment.id, Payment.payer_name, Payment.amount, Payment.unit_id, Payment.created_at)
+        .where(Payment.receipt_id == receipt_id)
+        .order_by(Payment.created_at.desc()),
+    )
+
+
+async def _read_room(session: AsyncSession, receipt_id: uuid.UUID) -> RoomSnapshot:
+    queries = room_queries(receipt_id)
+    receipt = (await session.execute(queries.receipt)).one()
+    items = (await session.execute(queries.items)).all()
+    units = (await session.execute(queries.units)).all()
+    payments = (await session.execute(queries.payments)).all()
+    return RoomSnapshot(receipt.revision, dumps(room_body(receipt, items, units, payments)))
+
+
+class RoomSnapshotCache:
+    """
+    Per-process cache of encoded room bodies keyed by token.
+
+    Callers first ``lookup`` the current ``receipts.revision`` (one indexed
+    read); the full room (items, units, payments) is only reloaded when the
+    revision moved, and concurrent readers of the same stale room share a
+    single reload.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, RoomSnapshot] = OrderedDict()
+        # A lock lives as long as some request holds it, so everyone reloading one room shares it.
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    def _cached(self, token: str, revision: int) -> RoomSnapshot | None:
+        snapshot = self._entries.get(token)
+        if snapshot is None or snapshot.revision < revision:
+            return None
+        self._entries.move_to_end(token)
+        return snapshot
+
+    @staticmethod
+    async def lookup(session: AsyncSession, token: str) -> tuple[uuid.UUID, int] | None:
+        result = await session.execute(select(Receipt.id, Receipt.revision).where(Receipt.token == token))
+        row = result.one_or_none()
+        return None if row is None else (row.id, row.revision)
+
+    async def get(
+        self, session: AsyncSession, token: str, receipt_id: uuid.UUID, revision: int
+    ) -> RoomSnapshot:
+        """Snapshot of the room at ``revision`` or newer, as returned by ``lookup``."""
+        snapshot = self._cached(token, revision)
+        if snapshot is not None:
+            return snapshot
+        lock = self._locks.setdefault(token, asyncio.Lock())
+        async with lock:
+            snapshot = self._cached(token, revision)
+            if snapshot is None:
+                snapshot = await load_room(session, receipt_id)
+                self._store(token, snapshot)
+        return snapshot
+
+    def _store(self, token: str, snapshot: RoomSnapshot) -> None:
+        current = self._entries.get(token)
+        if current is not None and current.revision > snapshot.revision:
+            return
+        self._entries[token] = snapshot
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, token: str) -> None:
+        self._entries.pop(token, None)
+
+
+room_snapshots = RoomSnapshotCache(get_settings().room_snapshot_cache_size)
@@ -1,6 +1,69 @@
+const JOB_STAGE_LABELS = {
+  saved: "Файл загружен, ждём очереди на распознавание...",
+  preprocessing: "Готовим изображение...",
+  recognizing: "Распознаём текст...",
+  parsing: "Разбираем позиции...",
+  persisting: "Сохраняем чек...",
+};
+
+function watchJob(jobId, statusBox) {
+  let finished = false;
+  let pollTimer = null;
+  let ws = null;
+
+  const handle = (job) => {
+    if (finished) return;
+    if (job.stage === "done" && job.receipt_id) {
+      finished = true;
+      console.info("[upload] Чек распознан", { jobId, receiptId: job.receipt_id });
+      statusBox.textContent = "Готово! Перенаправляем на проверку...";
+      window.location.href = `/review/${job.receipt_id}`;
+    } else if (job.stage === "failed") {
+      finished = true;
+      console.error("[upload] Распознавание не удалось", { jobId, error: job.error });
+      statusBox.textContent = job.error || "Ошибка распознавания чека";
+    } else {
+      statusBox.textContent = JOB_STAGE_LABELS[job.stage] || "Распознаём чек...";
+    }
+    if (finished) {
+      clearInterval(pollTimer);
+      if (ws) ws.close();
+    }
+  };
+
+  const poll = async () => {
+    try {
+      const response = await fetch(`/api/receipt-jobs/${jobId}`);
+      if (response.ok) handle(await response.json());
+    } catch (err) {
+      console.warn("[upload] Не удалось получить статус задачи", err);
+    }
+  };
+
+  // Polling is the fallback; it runs rarely while the WebSocket delivers stage changes.
+  pollTimer = setInterval(poll, 3000);
+  try {
+    ws = new WebSocket(`${location.protocol === "https:" ? "wss" : "ws"}://${location.host}/ws/jobs/${jobId}`);
+    ws.onmessage = (event) => {
+      const message = JSON.parse(event.data);
+      if (message.type === "ping") {
+        ws.send(JSON.stringify({ type: "pong" }));
+        return;
+      }
+      const messages = message.type === "batch" ? message.messages : [message];
+      if (messages.every((item) => item.type === "job")) messages.forEach(handle);
+      else poll();
+    };
+    ws.onerror = () => poll();
+  } catch (err) {
+    console.warn("WebSocket недоступен", err);
+    poll();
+  }
+}
+
 async function postReceipt(form) {
   const statusBox = document.getElementById("status");
-  statusBox.textContent = "Распознаём чек...";
+  statusBox.textContent = "Загружаем чек...";
   const formData = new FormData(form);
   const fileInput = form.querySelector('input[type="file"]');
   const selectedFile = fileInput?.files?.[0];
@@ -14,7 +77,7 @@ async function postReceipt(form) {
     console.warn("[upload] Файл не выбран перед отправкой");
   }
   try {
-    const response = await fetch("/api/receipts", {
+    const response = await fetch("/api/receipt-jobs", {
       method: "POST",
       body: formData,
     });
@@ -31,13 +94,12 @@ async function postReceipt(form) {
         statusText: response.statusText,
         detail,
       });
-      statusBox.textContent = "Ошибка загрузки чека";
+      statusBox.textContent = response.status === 503 ? "Сервис перегружен, попробуйте позже" : "Ошибка загрузки чека";
       return;
     }
-    const data = await response.json();
-    console.info("[upload] Чек успешно загружен", { receiptId: data.receipt_id });
-    statusBox.textContent = "Готово! Перенаправляем на проверку...";
-    window.location.href = `/review/${data.receipt_id}`;
+    const job = await response.json();
+    console.info("[upload] Чек принят в обработку", { jobId: job.id });
+    watchJob(job.id, statusBox);
   } catch (err) {
     console.error("[upload] Не удалось отправить чек", err);
     statusBox.textContent = "Не удалось отправить чек";
@@ -57,6 +119,7 @@ function renderItems(items) {
   tbody.innerHTML = "";
   items.forEach((item) => {
     const row = document.createElement("tr");
+    row.dataset.id = item.id;
     row.innerHTML = `
       <td><input name="name" value="${item.name}" /></td>
       <td><input name="qty_total" type="number" step="1" min="1" value="${item.qty_total}" /></td>
@@ -73,6 +136,8 @@ function collectItems() {
   return Array.from(rows).map((row) => {
     const [name, qty, unit, total] = row.querySelectorAll("input");
     return {
+      // Rows loaded from the server keep their id so the save only touches what changed.
+      id: row.dataset.id || null,
       name: name.value.trim() || "Без названия",
       qty_total: Number(qty.value),
       unit_price: Number(unit.value),
@@ -91,7 +156,12 @@ async function saveItems(receiptId) {
   if (!response.ok) {
     throw new Error("Не удалось сохранить позиции");
   }
-  return response.json();
+  const saved = await response.json();
+  // New rows get their server ids, so a second save does not insert them again.
+  document.querySelectorAll("#items-body tr").forEach((row, index) => {
+    if (saved[index]) row.dataset.id = saved[index].id;
+  });
+  return saved;
 }
 
 async function finalizeReceipt(receiptId) {
@@ -155,21 +225,36 @@ async function initReviewPage() {
   });
 }
 
+const roomCache = { etag: null, data: null };
+
+// Returns the same object as before when the server answers 304, so callers can skip re-rendering.
 async function fetchRoom(token) {
-  const response = await fetch(`/api/receipts/${token}`);
+  const headers = roomCache.etag ? { "If-None-Match": roomCache.etag } : {};
+  const response = await fetch(`/api/receipts/${token}`, { headers, cache: "no-store" });
+  if (response.status === 304 && roomCache.data) return roomCache.data;
   if (!response.ok) throw new Error("Чек не найден");
-  return response.json();
+  roomCache.data = await response.json();
+  roomCache.etag = response.headers.get("ETag");
+  return roomCache.data;
+}
+
+async function refreshRoom(token, current) {
+  const data = await fetchRoom(token);
+  if (data !== current) renderRoom(data);
+  return data;
 }
 
 function renderRoom(data) {
   const container = document.getElementById("room");
   container.innerHTML = "";
+  const summary = document.createElement("p");
+  summary.textContent = `Оплачено ${data.units_paid}/${data.units_total} шт. · ${data.amount_paid} ₽`;
+  container.appendChild(summary);
   data.items.forEach((item) => {
     const section = document.createElement("section");
-    const paidUnits = item.units.filter((u) => u.status === "paid").length;
     section.innerHTML = `
       <h3>${item.name}</h3>
-      <p>${paidUnits}/${item.units.length} оплачено · ${item.unit_price} ₽ за шт.</p>
+      <p>${item.units_paid}/${item.qty_total} оплачено · ${item.unit_price} ₽ за шт.</p>
       <div class="units">${item.units
         .map(
           (unit) => `
@@ -195,32 +280,106 @@ function renderRoom(data) {
     .join("");
 }
 
+function newIdempotencyKey() {
+  if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
 async function sendPayment(token, payload) {
-  const response = await fetch(`/api/receipts/${token}/pay`, {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(payload),
-  });
+  // One key per payment: retries after a dropped connection are answered from the stored result.
+  const idempotencyKey = newIdempotencyKey();
+  let response;
+  for (let attempt = 0; ; attempt += 1) {
+    try {
+      response = await fetch(`/api/receipts/${token}/pay`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json", "Idempotency-Key": idempotencyKey },
+        body: JSON.stringify(payload),
+      });
+      break;
+    } catch (err) {
+      if (attempt >= 2) throw err;
+      await new Promise((resolve) => setTimeout(resolve, 1000 * (attempt + 1)));
+    }
+  }
   if (!response.ok) {
     const detail = await response.json();
     throw new Error(detail.detail || "Ошибка оплаты");
   }
+  return response.json();
+}
+
+function applyPaymentDelta(data, delta) {
+  const changed = new Map(delta.units.map((unit) => [unit.id, unit]));
+  const progress = new Map(delta.items.map((item) => [item.id, item]));
+  return {
+    ...data,
+    revision: delta.seq,
+    status: delta.receipt_status,
+    units_total: delta.units_total,
+    units_paid: delta.units_paid,
+    amount_paid: delta.amount_paid,
+    items: data.items.map((item) => ({
+      ...item,
+      ...(progress.has(item.id)
+        ? { units_paid: progress.get(item.id).units_paid, amount_paid: progress.get(item.id).amount_paid }
+        : {}),
+      units: item.units.map((unit) => {
+        const update = changed.get(unit.id);
+        return update ? { ...unit, amount_paid: update.amount_paid, status: update.status } : unit;
+      }),
+    })),
+    // The room lists payments newest first; a delta carries them in the order they were made.
+    payments: [...delta.payments].reverse().concat(data.payments),
+  };
 }
 
 async function initRoomPage() {
   const token = document.body.dataset.token;
   const nameInput = document.getElementById("payer-name");
-  const payButton = document.getElementById("pay-selected");
   let latestData = await fetchRoom(token);
+  let ws = null;
+  // Messages are applied one at a time so a resync cannot interleave with a delta.
+  let updates = Promise.resolve();
   renderRoom(latestData);
 
+  const resync = async () => {
+    latestData = await refreshRoom(token, latestData);
+  };
+
+  const applyMessage = async (message) => {
+    if (message.type === "batch") {
+      // Bursts are coalesced by the server; apply them in order, the seq checks still hold.
+      for (const item of message.messages) await applyMessage(item);
+      return;
+    }
+    if (message.type !== "payment" || message.seq > latestData.revision + 1) {
+      // Unknown message or a gap in the sequence: fall back to the full room.
+      await resync();
+    } else if (message.seq === latestData.revision + 1) {
+      latestData = applyPaymentDelta(latestData, message);
+      roomCache.data = latestData;
+      renderRoom(latestData);
+    }
+  };
+
+  const enqueue = (task) => {
+    updates = updates.then(task).catch((err) => console.warn("Не удалось обновить комнату", err));
+  };
+
+  const afterOwnPayment = (result) => {
+    // With a live socket our own delta arrives like everyone else's.
+    if (!ws || ws.readyState !== WebSocket.OPEN || result.seq > latestData.revision + 1) {
+      enqueue(resync);
+    }
+  };
+
   document.getElementById("room").addEventListener("click", async (event) => {
     if (event.target.classList.contains("pay-one")) {
       const payer = nameInput.value.trim() || "Гость";
       const itemId = event.target.dataset.item;
-      await sendPayment(token, { payer_name: payer, lines: [{ item_id: itemId, mode: "unit_full" }] });
-      latestData = await fetchRoom(token);
-      renderRoom(latestData);
+      const result = await sendPayment(token, { payer_name: payer, lines: [{ item_id: itemId, mode: "unit_full" }] });
+      afterOwnPayment(result);
     }
     if (event.target.classList.contains("unit-btn")) {
       const payer = nameInput.value.trim() || "Гость";
@@ -228,24 +387,40 @@ async function initRoomPage() {
       const itemId = event.target.dataset.item;
       const amount = prompt("Сколько оплатить?");
       if (!amount) return;
-      await sendPayment(token, {
+      const result = await sendPayment(token, {
         payer_name: payer,
         lines: [{ item_id: itemId, mode: "unit_partial", unit_id: unitId, amount: Number(amount) }],
       });
-      latestData = await fetchRoom(token);
-      renderRoom(latestData);
+      afterOwnPayment(result);
     }
   });
 
-  try {
-    const ws = new WebSocket(`${location.protocol === "https:" ? "wss" : "ws"}://${location.host}/ws/rooms/${token}`);
-    ws.onmessage = async () => {
-      latestData = await fetchRoom(token);
-      renderRoom(latestData);
+  const connect = (reconnecting) => {
+    try {
+      ws = new WebSocket(`${location.protocol === "https:" ? "wss" : "ws"}://${location.host}/ws/rooms/${token}`);
+    } catch (err) {
+      console.warn("WebSocket недоступен", err);
+      return;
+    }
+    ws.onopen = () => {
+      // Anything sent while we were disconnected is gone; catch up with one conditional GET.
+      if (reconnecting) enqueue(resync);
     };
-  } catch (err) {
-    console.warn("WebSocket недоступен", err);
-  }
+    ws.onmessage = (event) => {
+      const message = JSON.parse(event.data);
+      if (message.type === "ping") {
+        // The server closes sockets that stay silent past its idle timeout.
+        ws.send(JSON.stringify({ type: "pong" }));
+        return;
+      }
+      enqueue(() => applyMessage(message));
+    };
+    ws.onclose = (event) => {
+      // 1013: the server is at its connection limit, give it more time.
+      setTimeout(() => connect(true), event.code === 1013 ? 10000 : 2000);
+    };
+  };
+  connect(false);
 }
 
 document.addEventListener("DOMContentLoaded", () => {
@@ -0,0 +1,294 @@
+"""
+OCR pipeline benchmark on the synthetic receipt corpus.
+
+Runs every receipt of ``benchmarks/ocr/receipts.json`` through
+``extract_items`` end to end (save, preprocess, Tesseract, parse) with the
+OCR cache off, ``--repeat`` times, and reports per-stage latency percentiles
+(the same stage timings ``/metrics`` exposes), peak memory and item-level
+accuracy against the ground truth as JSON:
+
+    python -m benchmarks.ocr --output before.json
+    python -m benchmarks.ocr --output after.json --baseline before.json
+
+With ``--baseline`` the run exits with status 1 when the p50 of the total time
+grew by more than ``--max-slowdown`` or the item F1 score dropped by more than
+``--max-accuracy-drop``. No database is needed; the usual OCR_* settings apply.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import difflib
+import hashlib
+import io
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+import PIL
+from fastapi import UploadFile
+from PIL import ImageFont
+from prometheus_client import REGISTRY
+
+from app.core.config import get_settings
+from app.schemas import ParsedOcrItem
+from app.services.ocr import extract_items, ocr_fingerprint
+from app.services.ocr_backends import OcrEngineError
+from app.services.ocr_cache import ocr_cache
+from app.services.ocr_pool import ocr_pool
+from benchmarks.ocr.corpus import CORPUS_PATH, FONT_SIZE, CorpusReceipt, find_font, load_corpus, render
+
+
+STAGES = ("save", "preprocess", "tesseract", "parse")
+PREPROCESS_STEPS = ("decode", "crop", "resize", "binarize", "deskew")
+PERCENTILES = (50, 90, 99)
+# Names at least this similar to the ground truth count as recognised.
+NAME_MATCH_RATIO = 0.8
+
+
+def stage_totals() -> dict[str, float]:
+    totals = {}
+    for stage in STAGES:
+        value = REGISTRY.get_sample_value("ocr_stage_seconds_sum", {"stage": stage})
+        if value is not None:
+            totals[stage] = value
+    for step in PREPROCESS_STEPS:
+        value = REGISTRY.get_sample_value("ocr_preprocess_step_seconds_sum", {"step": step})
+        if value is not None:
+            totals[f"preprocess.{step}"] = value
+    return totals
+
+
+def _normalize_name(name: str) -> str:
+    return " ".join(name.lower().split())
+
+
+def _same_numbers(expected: ParsedOcrItem, found: ParsedOcrItem) -> bool:
+    return (
+        expected.quantity == found.quantity
+        and abs(expected.price - found.price) < 0.005
+        and abs(expected.total - found.total) < 0.005
+    )
+
+
+def score_items(expected: list[ParsedOcrItem], found: list[ParsedOcrItem]) -> dict:
+    """
+    Match recognised items to the ground truth one to one.
+
+    An item counts as matched when price, quantity and total are exact and the
+    name is at least NAME_MATCH_RATIO similar; ``exact_names`` counts matches
+    whose name is identical up to case and whitespace.
+    """
+    remaining = list(found)
+    matched = exact_names = 0
+    similarities = []
+    for item in expected:
+        candidates = [
+            (difflib.SequenceMatcher(None, _normalize_name(item.name), _normalize_name(other.name)).ratio(), index)
+            for index, other in enumerate(remaining)
+            if _same_numbers(item, other)
+        ]
+        if not candidates:
+            continue
+        ratio, index = max(candidates)
+        if ratio < NAME_MATCH_RATIO:
+            continue
+        remaining.pop(index)
+        matched += 1
+        exact_names += ratio == 1.0
+        similarities.append(ratio)
+    return {
+        "expected": len(expected),
+        "found": len(found),
+        "matched": matched,
+        "exact_names": exact_names,
+        "parse_errors": sum(item.parse_error for item in found),
+        "name_similarity": round(float(np.mean(similarities)), 4) if similarities else None,
+    }
+
+
+def summarize_accuracy(scores: list[dict]) -> dict:
+    expected = sum(score["expected"] for score in scores)
+    found = sum(score["found"] for score in scores)
+    matched = sum(score["matched"] for score in scores)
+    precision = matched / found if found else 0.0
+    recall = matched / expected if expected else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {
+        "expected": expected,
+        "found": found,
+        "matched": matched,
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(f1, 4),
+        "exact_name_rate": round(sum(score["exact_names"] for score in scores) / expected, 4) if expected else 0.0,
+        "parse_errors": sum(score["parse_errors"] for score in scores),
+        "receipts_fully_matched": sum(score["matched"] == score["expected"] == score["found"] for score in scores),
+    }
+
+
+def latency_summary(samples: list[float]) -> dict:
+    values = np.array(samples) * 1000
+    summary = {f"p{p}": round(float(np.percentile(values, p)), 2) for p in PERCENTILES}
+    summary["mean"] = round(float(values.mean()), 2)
+    summary["max"] = round(float(values.max()), 2)
+    return summary
+
+
+def max_rss_mb(who: int) -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(who).ru_maxrss / divisor, 1)
+
+
+async def run_once(receipt: CorpusReceipt, data: bytes, suffix: str, media_root: Path, trace: bool) -> dict:
+    upload = UploadFile(file=io.BytesIO(data), filename=f"{receipt.id}{suffix}")
+    before = stage_totals()
+    if trace:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    path, _, items = await extract_items(upload, media_root)
+    elapsed = time.perf_counter() - started
+    path.unlink(missing_ok=True)
+    timings = {stage: seconds - before.get(stage, 0.0) for stage, seconds in stage_totals().items()}
+    timings["total"] = elapsed
+    return {
+        "timings": timings,
+        "items": items,
+        "peak_bytes": tracemalloc.get_traced_memory()[1] - baseline if trace else None,
+    }
+
+
+def compare(report: dict, baseline: dict, max_slowdown: float, max_accuracy_drop: float) -> list[str]:
+    problems = []
+    old_p50 = baseline["latency_ms"]["total"]["p50"]
+    new_p50 = report["latency_ms"]["total"]["p50"]
+    if new_p50 > old_p50 * (1 + max_slowdown):
+        problems.append(f"total p50 {old_p50:.0f} ms -> {new_p50:.0f} ms")
+    old_f1 = baseline["accuracy"]["f1"]
+    new_f1 = report["accuracy"]["f1"]
+    if new_f1 < old_f1 - max_accuracy_drop:
+        problems.append(f"item F1 {old_f1:.3f} -> {new_f1:.3f}")
+    return problems
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus", type=Path, default=CORPUS_PATH)
+    parser.add_argument("--font", help="TrueType font with Cyrillic glyphs")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the corpus")
+    parser.add_argument("--only", action="append", help="receipt id to run (repeatable)")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="skip per-image Python allocation tracking")
+    parser.add_argument("--output", type=Path, help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", type=Path, help="earlier report to check for regressions")
+    parser.add_argument("--max-slowdown", type=float, default=0.2)
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.02)
+    args = parser.parse_args()
+
+    receipts = [r for r in load_corpus(args.corpus) if not args.only or r.id in args.only]
+    if not receipts:
+        print("no receipts selected", file=sys.stderr)
+        return 2
+    font_path = find_font(args.font)
+    font = ImageFont.truetype(font_path, FONT_SIZE)
+    images = {receipt.id: render(receipt, font) for receipt in receipts}
+    # Cached results would skip every stage after the first pass.
+    ocr_cache.enabled = False
+    trace = not args.no_tracemalloc
+
+    samples: dict[str, list[float]] = {}
+    per_receipt: dict[str, dict] = {receipt.id: {"total_ms": [], "peak_bytes": []} for receipt in receipts}
+    scores: dict[str, dict] = {}
+    try:
+        with tempfile.TemporaryDirectory(prefix="ocr-benchmark-") as media_dir:
+            media_root = Path(media_dir)
+            # Warm-up: worker threads or processes and the OCR engine start on the first job.
+            await run_once(receipts[0], *images[receipts[0].id], media_root, trace=False)
+            if trace:
+                tracemalloc.start()
+            for _ in range(args.repeat):
+                for receipt in receipts:
+                    result = await run_once(receipt, *images[receipt.id], media_root, trace)
+                    for stage, seconds in result["timings"].items():
+                        samples.setdefault(stage, []).append(seconds)
+                    per_receipt[receipt.id]["total_ms"].append(result["timings"]["total"] * 1000)
+                    per_receipt[receipt.id]["peak_bytes"].append(result["peak_bytes"])
+                    # The pipeline is deterministic, so the first pass decides the accuracy.
+                    scores.setdefault(receipt.id, score_items(receipt.items, result["items"]))
+    except OcrEngineError as exc:
+        print(f"OCR engine failed: {exc}", file=sys.stderr)
+        return 2
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        ocr_pool.shutdown()
+
+    settings = get_settings()
+    peaks = [peak for row in per_receipt.values() for peak in row["peak_bytes"] if peak is not None]
+    report = {
+        "corpus": {
+            "path": str(args.corpus),
+            "sha256": hashlib.sha256(args.corpus.read_bytes()).hexdigest(),
+            "receipts": len(receipts),
+            "repeat": args.repeat,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "pillow": PIL.__version__,
+            "font": font_path,
+            "ocr_executor": settings.ocr_executor,
+            "ocr_workers": settings.ocr_workers,
+            "pipeline": json.loads(ocr_fingerprint()),
+        },
+        "latency_ms": {stage: latency_summary(values) for stage, values in samples.items()},
+        "memory": {
+            "tracemalloc_peak_mb": round(max(peaks) / 1024 / 1024, 1) if peaks else None,
+            "max_rss_mb": max_rss_mb(resource.RUSAGE_SELF),
+            "children_max_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN),
+        },
+        "accuracy": summarize_accuracy(list(scores.values())),
+        "receipts": [
+            {
+                "id": receipt.id,
+                "total_ms_p50": round(float(np.median(per_receipt[receipt.id]["total_ms"])), 2),
+                **scores[receipt.id],
+            }
+            for receipt in receipts
+        ],
+    }
+
+    rendered = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(rendered + "\n", encoding="utf-8")
+    else:
+        print(rendered)
+    total = report["latency_ms"]["total"]
+    accuracy = report["accuracy"]
+    print(
+        f"{len(receipts)} receipts x {args.repeat}: total p50 {total['p50']:.0f} ms, p99 {total['p99']:.0f} ms; "
+        f"items matched {accuracy['matched']}/{accuracy['expected']} (F1 {accuracy['f1']:.3f}); "
+        f"max RSS {report['memory']['max_rss_mb']} MB",
+        file=sys.stderr,
+    )
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        problems = compare(report, baseline, args.max_slowdown, args.max_accuracy_drop)
+        for problem in problems:
+            print(f"regression: {problem}", file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,173 @@
+"""
+Synthetic receipt corpus for the OCR benchmark.
+
+``receipts.json`` holds the ground truth: header lines, items with price,
+quantity and total, and the distortions to apply (``rotation`` in degrees,
+Gaussian ``noise`` sigma, ``blur`` kernel, dark ``background`` with a
+``margin`` around the paper, ``scale`` and JPEG ``quality``). Images are
+rendered from it on the fly with a fixed seed per receipt, so the corpus stays
+reviewable in git and every run sees the same pixels for the same font and
+library versions. To look at the images:
+
+    python -m benchmarks.ocr.corpus --out /tmp/ocr-corpus
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from app.schemas import ParsedOcrItem
+
+
+CORPUS_PATH = Path(__file__).with_name("receipts.json")
+FONT_CANDIDATES = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
+    "/usr/share/fonts/TTF/DejaVuSansMono.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSansMono.ttf",
+    "/Library/Fonts/DejaVuSansMono.ttf",
+)
+
+# 80 mm thermal paper at ~180 dpi.
+PAPER_WIDTH = 576
+FONT_SIZE = 22
+LINE_HEIGHT = 30
+PADDING = 24
+
+
+@dataclass
+class CorpusReceipt:
+    id: str
+    lines: list[str]
+    items: list[ParsedOcrItem]
+    distort: dict
+    seed: int
+
+
+def find_font(path: str | None = None) -> str:
+    candidates = (path,) if path else FONT_CANDIDATES
+    for candidate in candidates:
+        if candidate and Path(candidate).is_file():
+            return candidate
+    raise SystemExit("No Cyrillic TrueType font found; install fonts-dejavu-core or pass --font")
+
+
+def _money(value: float) -> str:
+    return f"{value:.2f}"
+
+
+def receipt_lines(spec: dict) -> list[str]:
+    lines = [*spec["header"], "КАССОВЫЙ ЧЕК", "ИНН 7701234567", "Кассир Иванова", ""]
+    for position, item in enumerate(spec["items"], 1):
+        prefix = f"{position}. " if spec.get("numbered") else ""
+        lines.append(prefix + item["name"])
+        if item.get("qty_style") == "weight":
+            lines.append(f"{_money(item['price'])} * {item['quantity']}.000 = {_money(item['total'])}")
+        else:
+            lines.append(f"{_money(item['price'])} x {item['quantity']} = {_money(item['total'])}")
+    total = sum(item["total"] for item in spec["items"])
+    lines += ["", f"ИТОГ ={_money(total)}", f"БЕЗНАЛИЧНЫЕ ={_money(total)}", "ФН 9960440300123456", "ФП 2871349921"]
+    return lines
+
+
+def load_corpus(path: Path = CORPUS_PATH) -> list[CorpusReceipt]:
+    data = json.loads(path.read_text(encoding="utf-8"))
+    return [
+        CorpusReceipt(
+            id=spec["id"],
+            lines=receipt_lines(spec),
+            items=[
+                ParsedOcrItem(
+                    name=item["name"],
+                    price=item["price"],
+                    quantity=item["quantity"],
+                    total=item["total"],
+                    is_promo=False,
+                    parse_error=False,
+                )
+                for item in spec["items"]
+            ],
+            distort=spec.get("distort", {}),
+            seed=spec["seed"],
+        )
+        for spec in data["receipts"]
+    ]
+
+
+def render_paper(lines: list[str], font: ImageFont.FreeTypeFont) -> np.ndarray:
+    image = Image.new("L", (PAPER_WIDTH, PADDING * 2 + LINE_HEIGHT * len(lines)), 255)
+    draw = ImageDraw.Draw(image)
+    for index, line in enumerate(lines):
+        draw.text((PADDING, PADDING + index * LINE_HEIGHT), line, font=font, fill=0)
+    return np.asarray(image)
+
+
+def distort(paper: np.ndarray, options: dict, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    image = paper
+    margin = options.get("margin", 0)
+    background = options.get("background", 255)
+    if margin:
+        image = cv2.copyMakeBorder(image, margin, margin, margin, margin, cv2.BORDER_CONSTANT, value=background)
+    if options.get("rotation"):
+        # Grow the canvas so the corners of the paper are not cut off.
+        h, w = image.shape[:2]
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), options["rotation"], 1.0)
+        cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+        new_w, new_h = round(h * sin + w * cos), round(h * cos + w * sin)
+        matrix[0, 2] += (new_w - w) / 2
+        matrix[1, 2] += (new_h - h) / 2
+        image = cv2.warpAffine(image, matrix, (new_w, new_h), flags=cv2.INTER_CUBIC, borderValue=background)
+    if options.get("scale"):
+        interpolation = cv2.INTER_AREA if options["scale"] < 1 else cv2.INTER_CUBIC
+        image = cv2.resize(image, None, fx=options["scale"], fy=options["scale"], interpolation=interpolation)
+    if options.get("blur"):
+        image = cv2.GaussianBlur(image, (options["blur"], options["blur"]), 0)
+    if options.get("noise"):
+        noisy = image.astype(np.float32) + rng.normal(0, options["noise"], image.shape)
+        image = np.clip(noisy, 0, 255).astype(np.uint8)
+    return image
+
+
+def encode(image: np.ndarray, options: dict) -> tuple[bytes, str]:
+    if "quality" in options:
+        ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, options["quality"]])
+        suffix = ".jpg"
+    else:
+        ok, buffer = cv2.imencode(".png", image)
+        suffix = ".png"
+    if not ok:
+        raise RuntimeError("OpenCV failed to encode the receipt image")
+    return buffer.tobytes(), suffix
+
+
+def render(receipt: CorpusReceipt, font: ImageFont.FreeTypeFont) -> tuple[bytes, str]:
+    image = distort(render_paper(receipt.lines, font), receipt.distort, receipt.seed)
+    return encode(image, receipt.distort)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out", type=Path, required=True, help="directory for the rendered images")
+    parser.add_argument("--corpus", type=Path, default=CORPUS_PATH)
+    parser.add_argument("--font", help="TrueType font with Cyrillic glyphs")
+    args = parser.parse_args()
+
+    font = ImageFont.truetype(find_font(args.font), FONT_SIZE)
+    receipts = load_corpus(args.corpus)
+    args.out.mkdir(parents=True, exist_ok=True)
+    for receipt in receipts:
+        data, suffix = render(receipt, font)
+        (args.out / f"{receipt.id}{suffix}").write_bytes(data)
+        (args.out / f"{receipt.id}.txt").write_text("\n".join(receipt.lines) + "\n", encoding="utf-8")
+    print(f"rendered {len(receipts)} receipts to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Payment contention benchmark.
+
+Creates an open receipt with ``--items`` x ``--units`` units and lets
+``--payers`` concurrent clients pay for it through ``process_payment_lines``
+until every unit is paid, the way a banquet table settles one shared bill.
+Each payment takes ``--lines`` unit_full lines on random items.
+
+``--lock-receipt`` takes ``SELECT ... FOR UPDATE`` on the receipt before every
+payment, which reproduces the old whole-receipt serialisation for comparison:
+
+    python -m benchmarks.payment_contention --payers 32
+    python -m benchmarks.payment_contention --payers 32 --lock-receipt
+
+Run it against a scratch database (DATABASE_URL); the receipt is deleted at the end.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import secrets
+import statistics
+import time
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app.core.config import get_settings
+from app.models import ItemUnit, Receipt, ReceiptItem, ReceiptStatus
+from app.services.payments import PaymentError, process_payment_lines
+
+
+UNIT_PRICE = Decimal("100.00")
+
+
+async def create_receipt(session: AsyncSession, items: int, units: int) -> tuple[uuid.UUID, str, list[uuid.UUID]]:
+    receipt = Receipt(
+        token=secrets.token_urlsafe(16), status=ReceiptStatus.open, image_path="benchmark", units_total=items * units
+    )
+    session.add(receipt)
+    await session.flush()
+    item_rows = [
+        {
+            "id": uuid.uuid4(),
+            "receipt_id": receipt.id,
+            "name": f"Позиция {index + 1}",
+            "qty_total": units,
+            "unit_price": UNIT_PRICE,
+            "amount_total": UNIT_PRICE * units,
+        }
+        for index in range(items)
+    ]
+    await session.execute(insert(ReceiptItem), item_rows)
+    await session.execute(
+        insert(ItemUnit),
+        [
+            {"item_id": row["id"], "unit_index": index, "amount_total": UNIT_PRICE, "amount_paid": Decimal("0.00")}
+            for row in item_rows
+            for index in range(units)
+        ],
+    )
+    await session.commit()
+    return receipt.id, receipt.token, [row["id"] for row in item_rows]
+
+
+async def payer(
+    sessionmaker: async_sessionmaker,
+    token: str,
+    open_items: list[uuid.UUID],
+    lines: int,
+    lock_receipt: bool,
+    latencies: list[float],
+    counters: dict[str, int],
+) -> None:
+    while open_items:
+        chosen = [random.choice(open_items) for _ in range(lines)]
+        started = time.perf_counter()
+        async with sessionmaker() as session:
+            try:
+                if lock_receipt:
+                    await session.execute(select(Receipt.id).where(Receipt.token == token).with_for_update())
+                await process_payment_lines(
+                    session,
+                    token=token,
+                    payer_name="benchmark",
+                    lines=[{"item_id": item_id, "mode": "unit_full"} for item_id in chosen],
+                )
+                await session.commit()
+            except PaymentError as exc:
+                await session.rollback()
+                if str(exc) == "Receipt is not open for payments":
+                    return
+                # Every unpaid unit of some chosen item is paid or held by another payer.
+                counters["rejected"] += 1
+                for item_id in set(chosen):
+                    if await _item_exhausted(session, item_id) and item_id in open_items:
+                        open_items.remove(item_id)
+                continue
+        latencies.append(time.perf_counter() - started)
+        counters["payments"] += 1
+        counters["units"] += lines
+
+
+async def _item_exhausted(session: AsyncSession, item_id: uuid.UUID) -> bool:
+    result = await session.execute(
+        select(ItemUnit.id).where(ItemUnit.item_id == item_id, ItemUnit.amount_paid < ItemUnit.amount_total).limit(1)
+    )
+    return result.first() is None
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", type=int, default=40)
+    parser.add_argument("--units", type=int, default=10)
+    parser.add_argument("--payers", type=int, default=16)
+    parser.add_argument("--lines", type=int, default=1)
+    parser.add_argument("--lock-receipt", action="store_true", help="serialise payments on the receipt row")
+    args = parser.parse_args()
+
+    engine = create_async_engine(get_settings().database_url, pool_size=args.payers + 1, max_overflow=0)
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    async with sessionmaker() as session:
+        receipt_id, token, item_ids = await create_receipt(session, args.items, args.units)
+
+    latencies: list[float] = []
+    counters = {"payments": 0, "units": 0, "rejected": 0}
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(
+            *(
+                payer(sessionmaker, token, item_ids, args.lines, args.lock_receipt, latencies, counters)
+                for _ in range(args.payers)
+            )
+        )
+        elapsed = time.perf_counter() - started
+        async with sessionmaker() as session:
+            status = (await session.execute(select(Receipt.status).where(Receipt.id == receipt_id))).scalar_one()
+    finally:
+        async with sessionmaker() as session:
+            await session.execute(delete(Receipt).where(Receipt.id == receipt_id))
+            await session.commit()
+        await engine.dispose()
+
+    latencies.sort()
+    mode = "receipt lock" if args.lock_receipt else "unit locks"
+    print(f"mode: {mode}, payers: {args.payers}, units: {args.items * args.units}, lines per payment: {args.lines}")
+    print(f"payments: {counters['payments']} ({counters['units']} units) in {elapsed:.2f}s")
+    print(f"throughput: {counters['payments'] / elapsed:.1f} payments/s, {counters['units'] / elapsed:.1f} units/s")
+    if latencies:
+        p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+        print(f"latency: p50 {statistics.median(latencies) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms")
+    print(f"rejected (no free unit): {counters['rejected']}, final receipt status: {status.value}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
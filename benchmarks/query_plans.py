@@ -0,0 +1,183 @@
+"""
+EXPLAIN check for the hot lookup paths.
+
+Seeds a scratch database with ``--receipts`` x ``--items`` x ``--units`` rows
+(two million units with the defaults) and about half as many payments, runs
+ANALYZE, then EXPLAINs the statements behind the room load and the payment
+engine, built by the app code itself, and fails if any of them reads a big
+table with a sequential scan:
+
+    python -m benchmarks.query_plans --seed
+    python -m benchmarks.query_plans            # re-check an already seeded database
+    python -m benchmarks.query_plans --cleanup  # drop the seeded rows
+
+Seeded receipts are marked with ``image_path = 'query-plan-check'``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from collections import Counter
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from app.core.config import get_settings
+from app.services.payments import lock_units_statement
+from app.services.room_snapshots import room_queries
+
+
+SEED_MARK = "query-plan-check"
+BIG_TABLES = {"items", "item_units", "payments"}
+
+SEED_STATEMENTS = [
+    """
+    INSERT INTO receipts (id, token, status, image_path, revision)
+    SELECT gen_random_uuid(), 'plan-' || r, 'open', :mark, 0
+    FROM generate_series(1, :receipts) AS r
+    """,
+    """
+    INSERT INTO items (id, receipt_id, name, qty_total, unit_price, amount_total)
+    SELECT gen_random_uuid(), receipts.id, 'item ' || i, :units, 100, 100 * :units
+    FROM receipts, generate_series(1, :items) AS i
+    WHERE receipts.image_path = :mark
+    """,
+    """
+    INSERT INTO item_units (id, item_id, unit_index, amount_total, amount_paid, status)
+    SELECT gen_random_uuid(), items.id, u, 100,
+           CASE WHEN u % 2 = 0 THEN 100 ELSE 0 END,
+           CASE WHEN u % 2 = 0 THEN 'paid'::unitstatus ELSE 'unpaid'::unitstatus END
+    FROM items JOIN receipts ON receipts.id = items.receipt_id, generate_series(0, items.qty_total - 1) AS u
+    WHERE receipts.image_path = :mark
+    """,
+    """
+    INSERT INTO payments (id, receipt_id, item_id, unit_id, payer_name, amount, created_at)
+    SELECT gen_random_uuid(), items.receipt_id, items.id, item_units.id, 'seed', 100,
+           now() - random() * interval '30 days'
+    FROM item_units
+    JOIN items ON items.id = item_units.item_id
+    JOIN receipts ON receipts.id = items.receipt_id
+    WHERE receipts.image_path = :mark AND item_units.status = 'paid'
+    """,
+]
+
+class Explain(Executable, ClauseElement):
+    """``EXPLAIN (FORMAT JSON)`` of a statement, compiled and bound exactly as the app executes it."""
+
+    inherit_cache = False
+
+    def __init__(self, statement: Executable) -> None:
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element: Explain, compiler, **kw) -> str:
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+
+def checks(receipt_id: uuid.UUID, item_id: uuid.UUID, unit_id: uuid.UUID) -> dict[str, Executable]:
+    """The statements the app sends on the hot paths, built by the app code with one seeded receipt's ids."""
+    room = room_queries(receipt_id)
+    return {
+        "room: receipt row": room.receipt,
+        "room: items of a receipt": room.items,
+        "room: units of the items": room.units,
+        "room: payments, newest first": room.payments,
+        "pay: lock picked and named units": lock_units_statement(receipt_id, Counter({item_id: 2}), {unit_id}),
+        # Not sent by the app: Postgres runs these lookups itself for ON DELETE CASCADE from units and items.
+        "delete: payments of a unit": text("SELECT 1 FROM payments WHERE unit_id = :id").bindparams(id=unit_id),
+        "delete: payments of an item": text("SELECT 1 FROM payments WHERE item_id = :id").bindparams(id=item_id),
+    }
+
+
+def seq_scans(plan: dict) -> list[str]:
+    found = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in BIG_TABLES:
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def index_names(plan: dict) -> list[str]:
+    names = [plan["Index Name"]] if "Index Name" in plan else []
+    for child in plan.get("Plans", []):
+        names.extend(index_names(child))
+    return names
+
+
+async def seed(connection: AsyncConnection, receipts: int, items: int, units: int) -> None:
+    params = {"mark": SEED_MARK, "receipts": receipts, "items": items, "units": units}
+    for statement in SEED_STATEMENTS:
+        started = time.perf_counter()
+        result = await connection.execute(text(statement), params)
+        print(f"seeded {result.rowcount} rows in {time.perf_counter() - started:.1f}s")
+    await connection.commit()
+
+
+async def check(connection: AsyncConnection) -> bool:
+    await connection.execute(text("ANALYZE receipts, items, item_units, payments"))
+    row = (
+        await connection.execute(
+            text(
+                "SELECT receipts.id, items.id, item_units.id FROM receipts "
+                "JOIN items ON items.receipt_id = receipts.id JOIN item_units ON item_units.item_id = items.id "
+                "WHERE receipts.image_path = :mark LIMIT 1"
+            ),
+            {"mark": SEED_MARK},
+        )
+    ).first()
+    if row is None:
+        print("no seeded data, run with --seed first")
+        return False
+    ok = True
+    for name, statement in checks(*row).items():
+        explained = await connection.execute(Explain(statement))
+        plan = explained.scalar_one()
+        plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+        scans = seq_scans(plan)
+        verdict = "FAIL" if scans else "ok"
+        detail = f"seq scan on {', '.join(scans)}" if scans else ", ".join(index_names(plan)) or "no index"
+        print(f"[{verdict}] {name}: {detail} (cost {plan['Total Cost']:.0f})")
+        ok = ok and not scans
+    await connection.rollback()
+    return ok
+
+
+async def cleanup(connection: AsyncConnection) -> None:
+    result = await connection.execute(text("DELETE FROM receipts WHERE image_path = :mark"), {"mark": SEED_MARK})
+    await connection.commit()
+    print(f"deleted {result.rowcount} seeded receipts")
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seed", action="store_true", help="insert the synthetic data before checking")
+    parser.add_argument("--cleanup", action="store_true", help="delete the synthetic data and exit")
+    parser.add_argument("--receipts", type=int, default=20000)
+    parser.add_argument("--items", type=int, default=10)
+    parser.add_argument("--units", type=int, default=10)
+    args = parser.parse_args()
+
+    engine = create_async_engine(get_settings().database_url)
+    try:
+        async with engine.connect() as connection:
+            if args.cleanup:
+                await cleanup(connection)
+                return 0
+            if args.seed:
+                await seed(connection, args.receipts, args.items, args.units)
+            return 0 if await check(connection) else 1
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
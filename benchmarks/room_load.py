@@ -0,0 +1,416 @@
+"""
+Room load test: many payers and many sockets against a running app.
+
+Creates ``--rooms`` open receipts of ``--items`` x ``--units`` units directly
+in the database, opens ``--sockets`` WebSocket clients per room (each loads
+the room first, like the page does, and refetches it on a gap in ``seq``),
+then runs ``--payers`` concurrent payers per room over HTTP until every room
+is paid or ``--duration`` runs out. A share ``--partial`` of the payments are
+``unit_partial`` on a random unit; the rest pay ``--lines`` whole units.
+Payers choose from what the room's sockets have seen, so stale views cause
+conflicts the way they do for real guests.
+
+    python -m benchmarks.room_load --rooms 4 --sockets 50 --payers 8
+    python -m benchmarks.room_load --output room-load.json
+
+Reported: payment latency percentiles and status codes, broadcast lag (from
+the payment response to each socket receiving its delta), refetches, the
+receipt lock wait/hold, request and fan-out histograms scraped from
+``/metrics`` before and after the run, and the peak RSS of the server
+processes found in /proc (run it on the app host or in the app container, or
+pass ``--server-pid``). DATABASE_URL must point at the app's database; the
+receipts are deleted at the end.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import httpx
+import numpy as np
+import websockets
+from prometheus_client.parser import text_string_to_metric_families
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app.core.config import get_settings
+from app.models import Receipt
+from benchmarks.payment_contention import create_receipt
+
+
+SERVER_CMDLINE = b"app.main:app"
+RSS_SAMPLE_SECONDS = 1.0
+DRAIN_SECONDS = 2.0
+PAY_ROUTE = "/api/receipts/{token}/pay"
+HISTOGRAMS = {
+    "receipt_lock_wait": ("payment_receipt_lock_wait_seconds", {}),
+    "receipt_lock_hold": ("payment_receipt_lock_hold_seconds", {}),
+    "pay_request": ("http_request_seconds", {"method": "POST", "route": PAY_ROUTE, "status": "200"}),
+    "pay_db": ("http_request_db_seconds", {"method": "POST", "route": PAY_ROUTE}),
+    "room_request": ("http_request_seconds", {"method": "GET", "route": "/api/receipts/{token}", "status": "200"}),
+    "broadcast_publish": ("ws_broadcast_seconds", {"stage": "publish"}),
+    "broadcast_fanout": ("ws_broadcast_seconds", {"stage": "fanout"}),
+}
+
+
+@dataclass
+class Room:
+    """One receipt under load and what its sockets have seen of it."""
+
+    token: str
+    revision: int = 0
+    closed: bool = False
+    qty: dict[str, int] = field(default_factory=dict)
+    units_paid: dict[str, int] = field(default_factory=dict)
+    unit_item: dict[str, str] = field(default_factory=dict)
+    unit_total: dict[str, float] = field(default_factory=dict)
+    unit_paid: dict[str, float] = field(default_factory=dict)
+    answered_at: dict[int, float] = field(default_factory=dict)
+    delivered_at: list[tuple[int, float]] = field(default_factory=list)
+
+    def load(self, snapshot: dict) -> None:
+        if snapshot["revision"] < self.revision:
+            return
+        self.revision = snapshot["revision"]
+        self.closed = snapshot["status"] != "open"
+        for item in snapshot["items"]:
+            self.qty[item["id"]] = item["qty_total"]
+            self.units_paid[item["id"]] = item["units_paid"]
+            for unit in item["units"]:
+                self.unit_item[unit["id"]] = item["id"]
+                self.unit_total[unit["id"]] = unit["amount_total"]
+                self.unit_paid[unit["id"]] = unit["amount_paid"]
+
+    def apply(self, delta: dict) -> None:
+        if delta["seq"] <= self.revision:
+            return
+        self.revision = delta["seq"]
+        self.closed = delta["receipt_status"] != "open"
+        for item in delta["items"]:
+            self.units_paid[item["id"]] = item["units_paid"]
+        for unit in delta["units"]:
+            self.unit_paid[unit["id"]] = unit["amount_paid"]
+
+    def open_items(self) -> list[str]:
+        return [item_id for item_id, qty in self.qty.items() if self.units_paid[item_id] < qty]
+
+    def open_units(self) -> list[str]:
+        return [unit_id for unit_id, total in self.unit_total.items() if self.unit_paid[unit_id] < total]
+
+
+@dataclass
+class Results:
+    latencies: list[float] = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    modes: Counter = field(default_factory=Counter)
+    room_loads: list[float] = field(default_factory=list)
+    gap_refetches: int = 0
+    frames: int = 0
+    messages: int = 0
+    socket_closes: Counter = field(default_factory=Counter)
+
+
+def percentiles(samples: list[float], scale: float = 1000) -> dict | None:
+    if not samples:
+        return None
+    values = np.array(samples) * scale
+    return {
+        "count": len(samples),
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p90": round(float(np.percentile(values, 90)), 2),
+        "p99": round(float(np.percentile(values, 99)), 2),
+        "max": round(float(values.max()), 2),
+    }
+
+
+async def scrape(client: httpx.AsyncClient) -> dict[tuple, float]:
+    response = await client.get("/metrics")
+    response.raise_for_status()
+    samples = {}
+    for family in text_string_to_metric_families(response.text):
+        for sample in family.samples:
+            samples[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+    return samples
+
+
+def histogram_delta(before: dict, after: dict, name: str, labels: dict) -> dict | None:
+    """
+    Count, mean and bucket-bound p50/p99 (ms) of what a histogram observed between two scrapes.
+
+    Quantiles are the upper bound of the bucket they fall into, so they are as
+    coarse as the histogram's buckets.
+    """
+
+    def value(key: tuple) -> float:
+        return after.get(key, 0.0) - before.get(key, 0.0)
+
+    wanted = tuple(sorted(labels.items()))
+    count = value((f"{name}_count", wanted))
+    if count <= 0:
+        return None
+    buckets = sorted(
+        (float(dict(key[1])["le"]), value(key))
+        for key in after
+        if key[0] == f"{name}_bucket" and tuple(item for item in key[1] if item[0] != "le") == wanted
+    )
+
+    def quantile(q: float) -> float | None:
+        for bound, cumulative in buckets:
+            if cumulative >= q * count:
+                return None if bound == float("inf") else round(bound * 1000, 2)
+        return None
+
+    return {
+        "count": int(count),
+        "mean": round(value((f"{name}_sum", wanted)) / count * 1000, 2),
+        "p50_bucket": quantile(0.5),
+        "p99_bucket": quantile(0.99),
+    }
+
+
+def server_pids() -> list[int]:
+    pids = []
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            if SERVER_CMDLINE in (entry / "cmdline").read_bytes():
+                pids.append(int(entry.name))
+        except OSError:
+            continue
+    return pids
+
+
+def rss_mb(pids: list[int]) -> float:
+    total_kb = 0
+    for pid in pids:
+        try:
+            for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    total_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return round(total_kb / 1024, 1)
+
+
+async def sample_rss(pids: list[int], peak: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        peak[0] = max(peak[0], rss_mb(pids))
+        try:
+            await asyncio.wait_for(stop.wait(), RSS_SAMPLE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def fetch_room(client: httpx.AsyncClient, room: Room, results: Results) -> None:
+    started = time.perf_counter()
+    response = await client.get(f"/api/receipts/{room.token}")
+    response.raise_for_status()
+    results.room_loads.append(time.perf_counter() - started)
+    room.load(response.json())
+
+
+async def socket_client(
+    client: httpx.AsyncClient, ws_url: str, room: Room, results: Results, ready: asyncio.Event
+) -> None:
+    last_seq = None
+    try:
+        async with websockets.connect(f"{ws_url}/ws/rooms/{room.token}", ping_interval=None) as websocket:
+            await fetch_room(client, room, results)
+            last_seq = room.revision
+            ready.set()
+            async for raw in websocket:
+                received = time.perf_counter()
+                results.frames += 1
+                frame = json.loads(raw)
+                for message in frame["messages"] if frame.get("type") == "batch" else [frame]:
+                    if message.get("type") == "ping":
+                        await websocket.send('{"type":"pong"}')
+                        continue
+                    if message.get("type") != "payment":
+                        continue
+                    results.messages += 1
+                    room.delivered_at.append((message["seq"], received))
+                    if message["seq"] > last_seq + 1:
+                        # Missed a delta: the page reloads the whole room here.
+                        results.gap_refetches += 1
+                        await fetch_room(client, room, results)
+                    else:
+                        room.apply(message)
+                    last_seq = max(last_seq, message["seq"])
+    except websockets.ConnectionClosed as exc:
+        code = exc.rcvd.code if exc.rcvd is not None else None
+        results.socket_closes[code] += 1
+    finally:
+        ready.set()
+
+
+async def payer(
+    client: httpx.AsyncClient, room: Room, results: Results, partial: float, lines: int, think: float, deadline: float
+) -> None:
+    name = f"load-{random.randrange(10**6)}"
+    while not room.closed and time.perf_counter() < deadline:
+        if random.random() < partial and (units := room.open_units()):
+            unit_id = random.choice(units)
+            remaining = room.unit_total[unit_id] - room.unit_paid[unit_id]
+            amount = round(min(remaining, room.unit_total[unit_id] * random.uniform(0.25, 0.6)), 2)
+            mode = "unit_partial"
+            body = [{"item_id": room.unit_item[unit_id], "mode": mode, "unit_id": unit_id, "amount": amount}]
+        elif items := room.open_items():
+            mode = "unit_full"
+            body = [{"item_id": random.choice(items), "mode": mode} for _ in range(lines)]
+        else:
+            await asyncio.sleep(0.05)
+            continue
+        started = time.perf_counter()
+        response = await client.post(f"/api/receipts/{room.token}/pay", json={"payer_name": name, "lines": body})
+        answered = time.perf_counter()
+        results.statuses[response.status_code] += 1
+        results.modes[mode] += 1
+        if response.status_code == 200:
+            results.latencies.append(answered - started)
+            room.answered_at[response.json()["seq"]] = answered
+        elif response.status_code == 400 and "not open" in response.text:
+            room.closed = True
+        if think:
+            await asyncio.sleep(random.uniform(0, 2 * think))
+
+
+def broadcast_lags(rooms: list[Room]) -> list[float]:
+    lags = []
+    for room in rooms:
+        for seq, received in room.delivered_at:
+            answered = room.answered_at.get(seq)
+            if answered is not None:
+                lags.append(received - answered)
+    return lags
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:8000", help="app base URL")
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--sockets", type=int, default=20, help="WebSocket clients per room")
+    parser.add_argument("--payers", type=int, default=8, help="concurrent payers per room")
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--units", type=int, default=5)
+    parser.add_argument("--lines", type=int, default=1, help="unit_full lines per payment")
+    parser.add_argument("--partial", type=float, default=0.3, help="share of unit_partial payments")
+    parser.add_argument("--think-ms", type=float, default=50, help="mean pause between a payer's payments")
+    parser.add_argument("--duration", type=float, default=120, help="stop paying after this many seconds")
+    parser.add_argument("--server-pid", type=int, action="append", help="server process to sample RSS of")
+    parser.add_argument("--output", type=Path, help="write the JSON report here")
+    args = parser.parse_args()
+
+    engine = create_async_engine(get_settings().database_url)
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    receipt_ids = []
+    rooms = []
+    ws_url = args.url.replace("http", "ws", 1)
+    connections = args.rooms * (args.sockets + args.payers) + 4
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    pids = args.server_pid or server_pids()
+    results = Results()
+    peak_rss = [0.0]
+    stop_sampling = asyncio.Event()
+    try:
+        async with sessionmaker() as session:
+            for _ in range(args.rooms):
+                receipt_id, token, _ = await create_receipt(session, args.items, args.units)
+                receipt_ids.append(receipt_id)
+                rooms.append(Room(token))
+        async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+            before = await scrape(client)
+            idle_rss = rss_mb(pids) if pids else None
+            readiness = []
+            sockets = []
+            for room in rooms:
+                for _ in range(args.sockets):
+                    readiness.append(asyncio.Event())
+                    sockets.append(asyncio.create_task(socket_client(client, ws_url, room, results, readiness[-1])))
+            await asyncio.gather(*(event.wait() for event in readiness))
+            connected_rss = rss_mb(pids) if pids else None
+            sampler = asyncio.create_task(sample_rss(pids, peak_rss, stop_sampling)) if pids else None
+
+            started = time.perf_counter()
+            deadline = started + args.duration
+            await asyncio.gather(
+                *(
+                    payer(client, room, results, args.partial, args.lines, args.think_ms / 1000, deadline)
+                    for room in rooms
+                    for _ in range(args.payers)
+                )
+            )
+            elapsed = time.perf_counter() - started
+            await asyncio.sleep(DRAIN_SECONDS)
+            for task in sockets:
+                task.cancel()
+            await asyncio.gather(*sockets, return_exceptions=True)
+            stop_sampling.set()
+            if sampler is not None:
+                await sampler
+            after = await scrape(client)
+            ws_stats = (await client.get("/api/ws/stats")).json()
+    finally:
+        async with sessionmaker() as session:
+            await session.execute(delete(Receipt).where(Receipt.id.in_(receipt_ids)))
+            await session.commit()
+        await engine.dispose()
+
+    payments = sum(results.statuses.values())
+    lags = broadcast_lags(rooms)
+    expected_deliveries = sum(len(room.answered_at) for room in rooms) * args.sockets
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "server_pid")},
+        "elapsed_seconds": round(elapsed, 2),
+        "rooms_paid": sum(room.closed for room in rooms),
+        "payments": {
+            "attempted": payments,
+            "ok": results.statuses[200],
+            "per_second": round(results.statuses[200] / elapsed, 1) if elapsed else None,
+            "status_codes": {str(code): count for code, count in sorted(results.statuses.items())},
+            "conflict_rate": round(results.statuses[409] / payments, 4) if payments else None,
+            "modes": dict(results.modes),
+            "latency_ms": percentiles(results.latencies),
+        },
+        "broadcast": {
+            "lag_ms": percentiles(lags),
+            "delivered": len(lags),
+            "expected": expected_deliveries,
+            "frames": results.frames,
+            "messages": results.messages,
+            "socket_closes": {str(code): count for code, count in results.socket_closes.items()},
+        },
+        "room_load_ms": percentiles(results.room_loads),
+        "gap_refetches": results.gap_refetches,
+        "server": {name: histogram_delta(before, after, *spec) for name, spec in HISTOGRAMS.items()},
+        "ws_stats_one_worker": ws_stats,
+        "server_rss_mb": {"pids": pids, "idle": idle_rss, "connected": connected_rss, "peak": peak_rss[0] or None},
+    }
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+    latency = report["payments"]["latency_ms"] or {}
+    lag = report["broadcast"]["lag_ms"] or {}
+    lock_wait = report["server"]["receipt_lock_wait"] or {}
+    print(f"rooms: {args.rooms} ({report['rooms_paid']} paid), {args.sockets} sockets and {args.payers} payers each")
+    codes = report["payments"]["status_codes"]
+    print(f"payments: {results.statuses[200]}/{payments} ok in {elapsed:.1f}s, status codes {codes}")
+    print(f"payment latency: p50 {latency.get('p50')} ms, p99 {latency.get('p99')} ms")
+    print(f"receipt lock wait: mean {lock_wait.get('mean')} ms, p99 <= {lock_wait.get('p99_bucket')} ms")
+    print(f"broadcast lag: p50 {lag.get('p50')} ms, p99 {lag.get('p99')} ms ({len(lags)}/{expected_deliveries} delivered)")
+    print(f"room loads: {len(results.room_loads)} ({results.gap_refetches} after a gap)")
+    print(f"server RSS: {report['server_rss_mb']['peak']} MB peak over {len(pids)} processes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
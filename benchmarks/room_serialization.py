@@ -0,0 +1,188 @@
+"""
+Room response serialisation microbenchmark.
+
+Builds one synthetic room of ``--items`` x ``--units`` units and ``--payments``
+payments in memory (no database) and times the two ways of producing the
+``GET /api/receipts/{token}`` body:
+
+- ``pydantic``: ``ReceiptRoomResponse`` from ORM objects through ``orm_mode``,
+  then FastAPI's ``response_model`` validation, ``jsonable_encoder`` and
+  ``json.dumps``, as the endpoint did before;
+- ``orjson``: ``room_body`` from query rows encoded with orjson, as
+  ``load_room`` does now.
+
+Each is timed for a snapshot miss (build and encode) and a hit (what every
+refetch pays once the snapshot is cached). Both bodies are checked to decode
+to the same document first:
+
+    python -m benchmarks.room_serialization --items 60 --units 8 --payments 400
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.core.fastjson import dumps, json_response
+from app.models import ItemUnit, Payment, Receipt, ReceiptItem, ReceiptStatus, UnitStatus
+from app.schemas import ReceiptRoomResponse
+from app.services.room_snapshots import room_body
+
+
+ReceiptRow = namedtuple("ReceiptRow", "token status revision units_total units_paid amount_paid created_at")
+ItemRow = namedtuple("ItemRow", "id name qty_total unit_price amount_total units_paid amount_paid")
+UnitRow = namedtuple("UnitRow", "id item_id unit_index amount_total amount_paid status")
+PaymentRow = namedtuple("PaymentRow", "id payer_name amount unit_id created_at")
+
+
+def build_room(items: int, units: int, payments: int) -> tuple[Receipt, list[Payment]]:
+    rng = random.Random(7)
+    now = datetime.now(timezone.utc)
+    receipt = Receipt(
+        id=uuid.uuid4(),
+        token="benchmark",
+        status=ReceiptStatus.open,
+        image_path="benchmark",
+        revision=payments,
+        created_at=now,
+    )
+    receipt.items = []
+    all_units = []
+    for index in range(items):
+        price = Decimal(rng.randrange(5000, 250000)) / 100
+        item = ReceiptItem(
+            id=uuid.uuid4(),
+            name=f"Позиция {index + 1}",
+            qty_total=units,
+            unit_price=price,
+            amount_total=price * units,
+            created_at=now,
+        )
+        item.units = [
+            ItemUnit(
+                id=uuid.uuid4(),
+                item_id=item.id,
+                unit_index=unit_index,
+                amount_total=price,
+                amount_paid=Decimal("0.00"),
+                status=UnitStatus.unpaid,
+            )
+            for unit_index in range(units)
+        ]
+        receipt.items.append(item)
+        all_units.extend(item.units)
+    paid = []
+    for index, unit in enumerate(rng.sample(all_units, min(payments, len(all_units)))):
+        unit.amount_paid, unit.status = unit.amount_total, UnitStatus.paid
+        paid.append(
+            Payment(
+                id=uuid.uuid4(),
+                item_id=unit.item_id,
+                unit_id=unit.id,
+                payer_name=f"Гость {index % 12}",
+                amount=unit.amount_total,
+                created_at=now + timedelta(seconds=index, microseconds=index * 7),
+            )
+        )
+    for item in receipt.items:
+        item.units_paid = sum(unit.status == UnitStatus.paid for unit in item.units)
+        item.amount_paid = sum((unit.amount_paid for unit in item.units), Decimal("0.00"))
+    receipt.units_total = len(all_units)
+    receipt.units_paid = len(paid)
+    receipt.amount_paid = sum((payment.amount for payment in paid), Decimal("0.00"))
+    return receipt, sorted(paid, key=lambda payment: payment.created_at, reverse=True)
+
+
+def as_rows(receipt: Receipt, payments: list[Payment]) -> tuple:
+    return (
+        ReceiptRow(*(getattr(receipt, name) for name in ReceiptRow._fields)),
+        [ItemRow(*(getattr(item, name) for name in ItemRow._fields)) for item in receipt.items],
+        [UnitRow(*(getattr(unit, name) for name in UnitRow._fields)) for item in receipt.items for unit in item.units],
+        [PaymentRow(*(getattr(payment, name) for name in PaymentRow._fields)) for payment in payments],
+    )
+
+
+def pydantic_snapshot(receipt: Receipt, payments: list[Payment]) -> ReceiptRoomResponse:
+    return ReceiptRoomResponse(
+        token=receipt.token,
+        status=receipt.status,
+        revision=receipt.revision,
+        units_total=receipt.units_total,
+        units_paid=receipt.units_paid,
+        amount_paid=receipt.amount_paid,
+        items=receipt.items,
+        payments=payments,
+        created_at=receipt.created_at,
+    )
+
+
+async def pydantic_response(field, snapshot: ReceiptRoomResponse) -> bytes:
+    content = await serialize_response(field=field, response_content=snapshot)
+    return JSONResponse(content=jsonable_encoder(content)).body
+
+
+async def timed(rounds: int, func, *args) -> float:
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = func(*args)
+        if asyncio.iscoroutine(result):
+            await result
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", type=int, default=60)
+    parser.add_argument("--units", type=int, default=8)
+    parser.add_argument("--payments", type=int, default=400)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    receipt, payments = build_room(args.items, args.units, args.payments)
+    rows = as_rows(receipt, payments)
+    field = create_response_field(name="Response_get_room", type_=ReceiptRoomResponse)
+
+    snapshot = pydantic_snapshot(receipt, payments)
+    old_body = await pydantic_response(field, snapshot)
+    new_body = dumps(room_body(*rows))
+    if json.loads(old_body) != json.loads(new_body):
+        raise SystemExit("the two paths produce different documents")
+
+    async def pydantic_miss() -> bytes:
+        return await pydantic_response(field, pydantic_snapshot(receipt, payments))
+
+    results = {
+        "pydantic miss": await timed(args.rounds, pydantic_miss),
+        "pydantic hit": await timed(args.rounds, pydantic_response, field, snapshot),
+        "orjson miss": await timed(args.rounds, lambda: dumps(room_body(*rows))),
+        "orjson hit": await timed(args.rounds, json_response, new_body),
+    }
+    print(
+        f"room: {args.items} items x {args.units} units, {len(payments)} payments; "
+        f"body {len(old_body)} bytes (pydantic) / {len(new_body)} bytes (orjson)"
+    )
+    for name, ms in results.items():
+        print(f"{name:>14}: {ms:8.3f} ms")
+    print(
+        f"speed-up: miss x{results['pydantic miss'] / results['orjson miss']:.1f}, "
+        f"hit x{results['pydantic hit'] / results['orjson hit']:.0f}"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,6 @@
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker) -> None:
+    # Drop the live gauges of a worker that exited; its counters and histograms stay in the totals.
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,110 @@
+"""
+Check and rebuild the denormalised paid counters on items and receipts.
+
+The counters (``units_paid``/``amount_paid`` on items, ``units_total``/
+``units_paid``/``amount_paid`` on receipts) are recomputed from item_units and
+compared with the stored values. Each receipt is handled in its own short
+transaction that locks its item rows by id and then the receipt row, the same
+order payments use, so the command is safe to run against a live database:
+
+    python -m scripts.rebuild_counters --dry-run      # report drift only
+    python -m scripts.rebuild_counters                # fix every receipt
+    python -m scripts.rebuild_counters --token <room token>
+
+Exits with status 1 when drift was found in --dry-run mode.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+
+from app.core.config import get_settings
+
+
+LOCK_ITEMS = "SELECT id FROM items WHERE receipt_id = :receipt_id ORDER BY id FOR NO KEY UPDATE"
+LOCK_RECEIPT = "SELECT id FROM receipts WHERE id = :receipt_id FOR NO KEY UPDATE"
+
+REBUILD_ITEMS = """
+UPDATE items
+SET units_paid = actual.units_paid, amount_paid = actual.amount_paid
+FROM (
+    SELECT items.id,
+           count(item_units.id) FILTER (WHERE item_units.status = 'paid') AS units_paid,
+           coalesce(sum(item_units.amount_paid), 0) AS amount_paid
+    FROM items LEFT JOIN item_units ON item_units.item_id = items.id
+    WHERE items.receipt_id = :receipt_id
+    GROUP BY items.id
+) AS actual
+WHERE items.id = actual.id
+  AND (items.units_paid, items.amount_paid) IS DISTINCT FROM (actual.units_paid, actual.amount_paid)
+RETURNING items.id
+"""
+
+REBUILD_RECEIPT = """
+UPDATE receipts
+SET units_total = actual.units_total, units_paid = actual.units_paid, amount_paid = actual.amount_paid
+FROM (
+    SELECT count(item_units.id) AS units_total,
+           count(item_units.id) FILTER (WHERE item_units.status = 'paid') AS units_paid,
+           coalesce(sum(item_units.amount_paid), 0) AS amount_paid
+    FROM items JOIN item_units ON item_units.item_id = items.id
+    WHERE items.receipt_id = :receipt_id
+) AS actual
+WHERE receipts.id = :receipt_id
+  AND (receipts.units_total, receipts.units_paid, receipts.amount_paid)
+      IS DISTINCT FROM (actual.units_total, actual.units_paid, actual.amount_paid)
+RETURNING receipts.id
+"""
+
+
+async def rebuild_receipt(connection: AsyncConnection, receipt_id, dry_run: bool) -> tuple[int, int]:
+    params = {"receipt_id": receipt_id}
+    await connection.execute(text(LOCK_ITEMS), params)
+    await connection.execute(text(LOCK_RECEIPT), params)
+    items = len((await connection.execute(text(REBUILD_ITEMS), params)).all())
+    receipts = len((await connection.execute(text(REBUILD_RECEIPT), params)).all())
+    if dry_run:
+        await connection.rollback()
+    else:
+        await connection.commit()
+    return items, receipts
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--dry-run", action="store_true", help="report drift without writing")
+    parser.add_argument("--token", help="only this room")
+    args = parser.parse_args()
+
+    engine = create_async_engine(get_settings().database_url)
+    drifted_items = drifted_receipts = 0
+    try:
+        async with engine.connect() as connection:
+            query = "SELECT id, token FROM receipts WHERE status != 'draft'"
+            params = {}
+            if args.token:
+                query += " AND token = :token"
+                params["token"] = args.token
+            receipts = (await connection.execute(text(query + " ORDER BY created_at"), params)).all()
+            await connection.rollback()
+            for receipt_id, token in receipts:
+                items, receipt = await rebuild_receipt(connection, receipt_id, args.dry_run)
+                if items or receipt:
+                    print(f"{token}: {items} item(s) and {receipt} receipt row(s) out of step")
+                drifted_items += items
+                drifted_receipts += receipt
+    finally:
+        await engine.dispose()
+
+    verb = "found" if args.dry_run else "fixed"
+    print(f"checked {len(receipts)} receipts, {verb} {drifted_items} item and {drifted_receipts} receipt counters")
+    return 1 if args.dry_run and (drifted_items or drifted_receipts) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,6 +1,10 @@
 #!/usr/bin/env bash
 set -euo pipefail
 
-alembic upgrade head
-exec gunicorn -k uvicorn.workers.UvicornWorker -w "${GUNICORN_WORKERS:-3}" -b 0.0.0.0:8000 app.main:app
+# Workers write metric samples here and /metrics merges them; stale files from a previous run would be double counted.
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus-multiproc}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 
+alembic upgrade head
+exec gunicorn -c scripts/gunicorn_conf.py -k uvicorn.workers.UvicornWorker -w "${GUNICORN_WORKERS:-3}" -b 0.0.0.0:8000 app.main:app